@@ -0,0 +1,51 @@
+"""Per-frame cost of the volume processing: naff AudioVolume (audioop) vs NumpyVolumeAudio
+
+run: python benchmarks/bench_audio.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "vodipy"))
+
+import audioop  # noqa: E402
+
+import numpy as np  # noqa: E402
+
+from player.VoDiPy_audio import NumpyVolumeAudio  # noqa: E402
+
+FRAME_SIZE = 3840  # 20 ms, 48 kHz, 16 bit stereo
+FRAMES = 20000
+
+
+def main():
+    rng = np.random.default_rng(0)
+    frame = rng.integers(-20000, 20000, FRAME_SIZE // 2, dtype=np.int16).tobytes()
+    audio = NumpyVolumeAudio("bench")
+    audio.volume = 0.5
+    audio.apply_gain(frame)
+
+    results = {
+        "AudioVolume (audioop.mul)": lambda: audioop.mul(frame, 2, 0.5),
+        "NumpyVolumeAudio, constant volume": lambda: audio.apply_gain(frame),
+    }
+
+    def ramping():
+        audio.volume = 0.3 if audio.volume == 0.5 else 0.5  # every frame is part of a ramp
+        audio.apply_gain(frame)
+    results["NumpyVolumeAudio, ramp"] = ramping
+
+    def limiting():
+        audio.volume = 4.0
+        audio.apply_gain(frame)
+    results["NumpyVolumeAudio, ramp + limiter"] = limiting
+
+    print(f"{FRAMES} frames of {FRAME_SIZE} bytes, one frame every 20 ms per stream")
+    for name, func in results.items():
+        seconds = min(timeit.repeat(func, number=FRAMES, repeat=3))
+        per_frame = seconds / FRAMES * 1e6
+        print(f"{name:<36} {per_frame:7.2f} µs/frame  {per_frame / 20000 * 100:5.3f}% of a core per stream")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,336 @@
+"""Benchmarks of the play pipeline without discord and youtube
+
+- a local aiohttp server stands in for the YouTube Data API (paginated playlistItems, videos.list)
+- yt-dlp extractions are replaced by a sleep of --extract-latency seconds
+- naff contexts, voice states and messages are fakes which only record what the player does
+
+Reported per playlist size: time to first song and full playlist ingest of case_command_play, memory of the
+queue, and the cost of add_yt_api_dummies, get_next_song and create_components.
+
+run: python benchmarks/bench_play.py [--sizes 50,5000,50000] [--extract-latency 0.3] [--api-latency 0.02]
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "vodipy"))
+
+from aiohttp import web  # noqa: E402
+
+from VoDiPy_defines import MusicPlayerSettings as MPSettings  # noqa: E402
+
+MPSettings.metadata_db_path = ":memory:"  # don't touch the metadata of the bot
+MPSettings.audio_cache = False
+MPSettings.metrics = False
+
+from naff import Permissions  # noqa: E402
+
+import utils.VoDiPy_api as VoDiPy_api  # noqa: E402
+from player.VoDiPy_classes import MusicPlayer, MusicPlayerQueue  # noqa: E402
+from player.VoDiPy_player import case_command_play  # noqa: E402
+from utils.VoDiPy_extract import extraction_engine  # noqa: E402
+
+PAGE_SIZE = 50
+PLAYLIST_PREFIX = "BENCH"  # playlist ids are BENCH<size>
+
+
+# --- YouTube Data API stand-in ---------------------------------------------------------------------------------------
+
+def fixture_video_id(size: int, index: int):
+    """Every playlist size has its own videos, so no run profits from the caches of another"""
+    return f"{size % 100000:05d}{index:06d}"
+
+
+def fixture_playlist_item(pl_id: str, size: int, index: int):
+    v_id = fixture_video_id(size, index)
+    return {
+        "kind": "youtube#playlistItem",
+        "snippet": {
+            "title": f"Benchmark song number {index}",
+            "videoOwnerChannelTitle": f"Benchmark channel {index % 100}",
+            "playlistId": pl_id,
+            "position": index,
+            "resourceId": {"kind": "youtube#video", "videoId": v_id},
+            "thumbnails": {"high": {"url": f"https://i.ytimg.com/vi/{v_id}/hqdefault.jpg"}},
+        },
+        "status": {"privacyStatus": "public"},
+    }
+
+
+def fixture_video(v_id: str):
+    return {
+        "kind": "youtube#video",
+        "id": v_id,
+        "snippet": {
+            "title": f"Benchmark song number {int(v_id[5:])}",
+            "channelTitle": f"Benchmark channel {int(v_id[5:]) % 100}",
+            "liveBroadcastContent": "none",
+            "thumbnails": {"high": {"url": f"https://i.ytimg.com/vi/{v_id}/hqdefault.jpg"}},
+        },
+        "status": {"privacyStatus": "public", "uploadStatus": "processed", "embeddable": True},
+        "contentDetails": {"duration": "PT3M30S"},
+    }
+
+
+def fixture_playlist_page(pl_id: str, page: int):
+    size = int(pl_id.removeprefix(PLAYLIST_PREFIX))
+    start = page * PAGE_SIZE
+    data = {
+        "kind": "youtube#playlistItemListResponse",
+        "pageInfo": {"totalResults": size, "resultsPerPage": PAGE_SIZE},
+        "items": [fixture_playlist_item(pl_id, size, i) for i in range(start, min(start + PAGE_SIZE, size))],
+    }
+    if start + PAGE_SIZE < size:
+        data["nextPageToken"] = str(page + 1)
+    return data
+
+
+class FakeYouTubeApi:
+    """Serves the playlistItems and videos endpoints from generated fixtures"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.requests = 0
+        self._runner = None
+        self.url = ""
+
+    async def _playlist_items(self, request: web.Request):
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        data = fixture_playlist_page(request.query["playlistId"], int(request.query.get("pageToken", 0)))
+        return web.Response(text=json.dumps(data), content_type="application/json")
+
+    async def _videos(self, request: web.Request):
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        data = {"items": [fixture_video(v_id) for v_id in request.query["id"].split(",")]}
+        return web.Response(text=json.dumps(data), content_type="application/json")
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/youtube/v3/playlistItems", self._playlist_items)
+        app.router.add_get("/youtube/v3/videos", self._videos)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]  # noqa
+        self.url = f"http://127.0.0.1:{port}/youtube/v3/"
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+
+def stub_extractor(latency: float):
+    """Replace yt-dlp with a sleep, the info dict looks like the one of a youtube video"""
+    async def extract(link: str, ydl_opt: dict, playlist_pos: int = None, guild_id: int = None, background=False):
+        await asyncio.sleep(latency)
+        v_id = link.rsplit("v=", 1)[-1]
+        return {
+            "id": v_id, "extractor_key": "Youtube", "title": f"Benchmark song number {v_id}",
+            "uploader": "Benchmark channel", "duration": 210, "webpage_url": link,
+            "url": f"https://bench.invalid/{v_id}?expire={int(time.time()) + 6 * 3600}",
+            "thumbnail": f"https://i.ytimg.com/vi/{v_id}/hqdefault.jpg", "acodec": "opus", "asr": 48000,
+        }
+    extraction_engine.extract = extract
+
+
+# --- naff fakes ------------------------------------------------------------------------------------------------------
+
+class FakeMessage:
+    def __init__(self):
+        self.id = id(self)
+        self.edits = 0
+
+    async def edit(self, *args, **kwargs):
+        self.edits += 1
+        return self
+
+    async def delete(self, *args, **kwargs):
+        pass
+
+    async def add_reaction(self, *args):
+        pass
+
+
+class FakeVoiceState:
+    """Records when the first audio got played and keeps 'playing' until stopped"""
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.volume = 1.0
+        self.playing = False
+        self.first_play = asyncio.Event()
+        self._stopped = asyncio.Event()
+
+    async def play(self, audio):
+        self.playing = True
+        self.first_play.set()
+        await self._stopped.wait()
+        self._stopped.clear()
+        self.playing = False
+
+    async def stop(self):
+        self._stopped.set()
+
+    async def disconnect(self):
+        self.channel = None
+
+
+class FakeBot:
+    def __init__(self):
+        self.mps = {}
+        self.voice_states = {}
+
+    def get_bot_voice_state(self, guild_id):
+        return self.voice_states.get(guild_id)
+
+
+class FakeChannel:
+    def __init__(self, bot: FakeBot, guild_id: int):
+        self.id = guild_id * 10
+        self.name = "benchmark"
+        self.type = 2
+        self.user_limit = 0
+        self.voice_members = []
+        self._bot = bot
+        self._guild_id = guild_id
+        self.voice_state = None
+
+    async def connect(self, deafened=False):
+        self.voice_state = FakeVoiceState(self)
+        self._bot.voice_states[self._guild_id] = self.voice_state
+        return self.voice_state
+
+    async def send(self, *args, **kwargs):
+        return FakeMessage()
+
+
+def fake_context(bot: FakeBot, guild_id: int):
+    """A context like a prefixed command in a guild, its author is in a voice channel"""
+    channel = FakeChannel(bot, guild_id)
+    author = SimpleNamespace(id=1, bot=False, mention="@bench", voice=SimpleNamespace(channel=channel, guild=None))
+    guild = SimpleNamespace(id=guild_id, me=SimpleNamespace(
+        has_permission=lambda *perms: False,
+        channel_permissions=lambda _: [Permissions.ADMINISTRATOR],
+    ))
+    author.voice.guild = guild
+    channel.voice_members = [author]
+
+    async def send(*args, **kwargs):
+        return FakeMessage()
+    return SimpleNamespace(bot=bot, guild=guild, guild_id=guild_id, channel=channel, author=author,
+                           message=FakeMessage(), send=send)
+
+
+# --- benchmarks ------------------------------------------------------------------------------------------------------
+
+async def bench_play_command(size: int, guild_id: int):
+    """Time to first song and full ingest of /play <playlist>"""
+    bot = FakeBot()
+    ctx = fake_context(bot, guild_id)
+    link = f"https://www.youtube.com/playlist?list={PLAYLIST_PREFIX}{size}"
+    start = time.perf_counter()
+    command = asyncio.create_task(case_command_play(ctx, link))
+    while not ctx.channel.voice_state:
+        await asyncio.sleep(0.001)
+    await ctx.channel.voice_state.first_play.wait()
+    first_song = time.perf_counter() - start
+    mp: MusicPlayer = bot.mps[guild_id]
+    while mp.queue.loader_tasks or mp.queue.pending_songs:
+        await asyncio.sleep(0.001)
+    ingest = time.perf_counter() - start
+    songs = len(mp.queue.songs)
+    await mp.stop()
+    await command
+    return first_song, ingest, songs
+
+
+def bench_queue_memory(size: int):
+    """Bytes per song of a queue filled with api dummies"""
+    pages = [fixture_playlist_page(f"{PLAYLIST_PREFIX}{size}", page) for page in range(-(-size // PAGE_SIZE))]
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    queue = MusicPlayerQueue()
+    for page in pages:
+        queue.add_yt_api_dummies(page, play_next=False)
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return used, queue
+
+
+def bench_queue_operations(size: int):
+    """µs per page of add_yt_api_dummies, per get_next_song and per create_components"""
+    pages = [fixture_playlist_page(f"{PLAYLIST_PREFIX}{size}", page) for page in range(-(-size // PAGE_SIZE))]
+    queue = MusicPlayerQueue()
+    start = time.perf_counter()
+    for page in pages:
+        queue.add_yt_api_dummies(page, play_next=False)
+    add_page = (time.perf_counter() - start) / len(pages) * 1e6
+    for song in queue.songs:  # no extraction in get_next_song
+        song.loaded = True
+
+    async def next_songs(count: int):
+        start_next = time.perf_counter()
+        for _ in range(count):
+            await queue.get_next_song()
+        return (time.perf_counter() - start_next) / count * 1e6
+
+    calls = 2000
+    next_song = asyncio.run(next_songs(calls))
+    queue.set_shuffle(True)
+    next_song_shuffle = asyncio.run(next_songs(calls))
+    queue.set_shuffle(False)
+
+    mp = MusicPlayer()
+    mp.queue = queue
+    queue.queue_pos = size // 2
+    start = time.perf_counter()
+    for _ in range(200):
+        mp.create_components()
+    components = (time.perf_counter() - start) / 200 * 1e6
+    return add_page, next_song, next_song_shuffle, components
+
+
+async def main_async(args):
+    api = FakeYouTubeApi(args.api_latency)
+    await api.start()
+    VoDiPy_api.YT_API_URL = api.url
+    stub_extractor(args.extract_latency)
+    print(f"api latency {args.api_latency * 1000:.0f} ms, extract latency {args.extract_latency * 1000:.0f} ms\n")
+    print(f"{'songs':>7} | {'first song':>10} | {'ingest':>8} | {'api calls':>9} | {'memory':>10} | {'per song':>8}")
+    for guild_id, size in enumerate(args.sizes, 1):
+        requests = api.requests
+        first_song, ingest, songs = await bench_play_command(size, guild_id)
+        used, _ = bench_queue_memory(size)
+        print(f"{songs:>7} | {first_song:>9.3f}s | {ingest:>7.3f}s | {api.requests - requests:>9} | "
+              f"{used / 1024:>7.0f}KiB | {used / max(songs, 1):>7.0f}B")
+    await VoDiPy_api.yt_api_session_close()
+    await api.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="50,5000,50000", type=lambda x: [int(size) for size in x.split(",")])
+    parser.add_argument("--extract-latency", default=0.3, type=float, help="seconds per yt-dlp extraction")
+    parser.add_argument("--api-latency", default=0.02, type=float, help="seconds per youtube api request")
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+    print(f"\n{'songs':>7} | {'add page':>10} | {'next song':>10} | {'shuffled':>10} | {'components':>10}")
+    for size in args.sizes:
+        add_page, next_song, next_song_shuffle, components = bench_queue_operations(size)
+        print(f"{size:>7} | {add_page:>8.0f}µs | {next_song:>8.1f}µs | {next_song_shuffle:>8.1f}µs | "
+              f"{components:>8.0f}µs")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,37 +1,157 @@
+from utils.VoDiPy_startup import startup_profile  # first import, it starts the clock of the start report
+
+import asyncio
+import multiprocessing
+import os
+import time
 from datetime import datetime
+from typing import Union
 
 from naff import listen, Client, Activity, ActivityType, Intents
 from naff.client.const import __version__ as naff_version
 
 import VoDiPy_secrets
 from VoDiPy_defines import MusicPlayerSettings as MPSettings
+from VoDiPy_defines import MusicPlayerStates as MPStates
+from utils.VoDiPy_api import yt_api_session_start, yt_api_session_close
+from utils.VoDiPy_audiocache import audio_cache
+from utils.VoDiPy_autocomplete import play_index
+from utils.VoDiPy_metadata import metadata_store
+from utils.VoDiPy_metrics import metrics
+from utils.VoDiPy_extract import extraction_engine, load_backend
+from player.VoDiPy_audio import load_numpy
+from player.VoDiPy_player import warm_player_keywords
 
 
 class CustomClient(Client):
     mps = {}
     """{guild_id: MusicPlayer}"""
 
+    def __init__(self, *args, shard_id: int = 0, **kwargs):
+        super().__init__(*args, shard_id=shard_id, **kwargs)
+        self.shard_id = shard_id
+        self.warm_up_task: Union[asyncio.Task, None] = None
+
+    @listen()
+    async def on_login(self):
+        startup_profile.mark("login")
+
+    async def _init_interactions(self):
+        startup_profile.mark("gateway & guild cache")
+        await super()._init_interactions()
+        startup_profile.mark("command sync")
+
+    @listen()
+    async def on_startup(self):
+        metadata_store.open()
+        await yt_api_session_start()
+        metrics.gauge("vodipy_players_active", "Music players which are not idle",
+                      lambda: sum(1 for mp in self.mps.values() if mp.state != MPStates.ready))
+        metrics.gauge("vodipy_queue_songs", "Songs in the queues of all guilds",
+                      lambda: sum(len(mp.queue.songs) for mp in self.mps.values()))
+        metrics.gauge("vodipy_queue_songs_pending", "Songs of playlists which are still getting added",
+                      lambda: sum(mp.queue.pending_songs for mp in self.mps.values()))
+        metrics.gauge("vodipy_guilds", "Guilds of this bot", lambda: len(self.guilds))
+        await metrics.start(self.shard_id)
+        startup_profile.mark("startup")
+        print(f"* {'-' * 40}\n"
+              f"* [{datetime.now().replace(microsecond=0)}]\n"
+              f"* Bot started.\n"
+              f"* Shard: {self.shard_id + 1}/{self.total_shards}\n"
+              f"* Naff: {naff_version}\n"
+              f"{startup_profile.report('Ready after')}\n"
+              f"* {'-' * 40}")
+        if MPSettings.opus_passthrough and MPSettings.starting_volume != 1.0:
+            print(f"* Opus passthrough is off until the volume is 100% (starting_volume: {MPSettings.starting_volume})")
+        self.warm_up_task = asyncio.create_task(self.warm_up())
+
+    async def warm_up(self):
+        """Load the heavy backends in the background, the bot already answers commands meanwhile"""
+        if extraction_engine.backend != "process":  # otherwise only the worker processes need yt-dlp
+            await asyncio.to_thread(load_backend)
+            startup_profile.mark("yt-dlp import")
+        await asyncio.to_thread(load_numpy)
+        startup_profile.mark("numpy import")
+        play_index.load(metadata_store.recent(MPSettings.autocomplete_size))
+        startup_profile.mark("autocomplete index")
+        await extraction_engine.warm()
+        startup_profile.mark("yt-dlp warm-up")
+        if MPSettings.warm_keywords:
+            await warm_player_keywords()
+            startup_profile.mark("player keywords")
+        print(startup_profile.report("Warm-up finished after"))
+
+    async def stop(self):
+        if self.warm_up_task:
+            self.warm_up_task.cancel()
+        await metrics.stop()
+        await yt_api_session_close()
+        await super().stop()
+        await audio_cache.close()
+        extraction_engine.shutdown()
+        metadata_store.close()
+
+
+def create_client(shard_id: int = 0, total_shards: int = 1):
+    """Create the bot with all extensions loaded
+
+    :param shard_id: the gateway shard of this process
+    :param total_shards: amount of shards of the bot
+    """
+    startup_profile.mark("imports")
+    client = CustomClient(
+        intents=Intents.GUILD_VOICE_STATES | Intents.GUILD_MESSAGES | Intents.GUILD_MESSAGE_CONTENT | Intents.GUILDS,
+        sync_interactions=shard_id == 0,  # the commands are the same for all shards
+        # delete_unused_application_cmds=True,
+        default_prefix=MPSettings.message_command_prefix,
+        activity=Activity(type=ActivityType.LISTENING, name="all your favorite songs"),
+        send_command_tracebacks=False,
+        shard_id=shard_id,
+        total_shards=total_shards
+    )
+    client.load_extension("extensions.VoDiPy_extension_player")
+    # client.load_extension("naff.debug_extension")  # adds /debug commands
+    startup_profile.mark("extensions")
+    return client
+
 
-client = CustomClient(
-    intents=Intents.GUILD_VOICE_STATES | Intents.GUILD_MESSAGES | Intents.GUILD_MESSAGE_CONTENT | Intents.GUILDS,
-    sync_interactions=True,
-    # delete_unused_application_cmds=True,
-    default_prefix=MPSettings.message_command_prefix,
-    activity=Activity(type=ActivityType.LISTENING, name="all your favorite songs"),
-    send_command_tracebacks=False
-)
+def run(shard_id: int = 0, total_shards: int = 1):
+    """Run one shard of the bot in this process"""
+    if total_shards > 1:  # the index of the audio cache is not shared, every shard gets its own part
+        audio_cache.path = os.path.join(MPSettings.audio_cache_path, f"shard_{shard_id}")
+        audio_cache.max_bytes //= total_shards
+    create_client(shard_id, total_shards).start(VoDiPy_secrets.token)
 
 
-@listen()
-async def on_startup():
-    print(f"* {'-' * 40}\n"
-          f"* [{datetime.now().replace(microsecond=0)}]\n"
-          f"* Bot started.\n"
-          f"* Naff: {naff_version}\n"
-          f"* {'-' * 40}")
+def run_shards(total_shards: int):
+    """Run every shard in its own process, shards which crash get restarted
 
+    :param total_shards: amount of shards of the bot
+    """
+    ctx = multiprocessing.get_context("spawn")
+    processes: dict[int, multiprocessing.Process] = {}
+    try:
+        while True:
+            for shard_id in range(total_shards):
+                process = processes.get(shard_id)
+                if process and (process.is_alive() or process.exitcode == 0):
+                    continue
+                if process:
+                    print(f"* Shard {shard_id} exited with code {process.exitcode}, restarting")
+                processes[shard_id] = ctx.Process(target=run, args=(shard_id, total_shards), name=f"shard_{shard_id}")
+                processes[shard_id].start()
+            if all(process.exitcode == 0 for process in processes.values()):
+                return
+            time.sleep(5)
+    except KeyboardInterrupt:  # the shards get the interrupt too and stop themselves
+        for process in processes.values():
+            process.join(10)
+            if process.is_alive():
+                process.terminate()
 
-client.load_extension("extensions.VoDiPy_extension_player")
-# client.load_extension("naff.debug_extension")  # adds /debug commands
 
-client.start(VoDiPy_secrets.token)
+if __name__ == "__main__":  # worker processes of the extraction engine and the shards import this module too
+    if MPSettings.shards > 1:
+        run_shards(MPSettings.shards)
+    else:
+        run()
@@ -8,8 +8,51 @@ class MusicPlayerSettings:
     timeout_empty = 60  # seconds after which the player disconnects if nobody is in the channel
     timeout_new_dj = 15  # seconds after which a new dj gets set if the current dj leaves
     leave_if_empty = True  # leave the channel if nobody is listening; False: Only admins can use stop & move
+    embed_update_interval = 3  # min seconds between two edits of the player message which weren't caused by a button
     warning_pl_count = 200  # warning if YouTube playlist is bigger than x
     no_playlist = True  # if video of a playlist is sent, use video
+    flat_playlists = True  # list non-YouTube playlists first and resolve their songs when they are needed
+    enrich_playlists = True  # get duration & playability of playlist songs in batches (1 api quota unit per 50 songs)
+    region_code = None  # f.e. "DE": skip YouTube songs which are blocked in this country
+    api_connection_limit = 20  # max simultaneous connections to the youtube api
+    api_keepalive_timeout = 60  # seconds an idle connection to the youtube api is kept open
+    api_dns_cache_ttl = 300  # seconds a dns lookup of the youtube api is cached
+    api_timeout = 7  # seconds after which a youtube api request is treated as failed
+    api_retries = 2  # retries of youtube api requests which failed temporarily (timeouts, 5xx, rate limits)
+    api_retry_backoff = 0.5  # seconds before the first retry, doubles with every retry and gets randomized
+    api_breaker_threshold = 5  # youtube api failures in a row after which the api isn't used for a while
+    api_breaker_timeout = 30  # seconds the youtube api isn't used after too many failures
+    api_daily_quota = 10000  # quota units of the api key per day, yt-dlp is used instead when they are used up
+    stream_cache_size = 2000  # amount of resolved songs which are kept in memory for all guilds
+    stream_cache_ttl = 3600  # seconds a resolved song is cached if its stream url has no expire timestamp
+    stream_cache_margin = 60  # seconds a stream url has to be valid longer than the song duration
+    metadata_db_path = "VoDiPy_metadata.db"  # sqlite file which stores song metadata, relative to the bot folder
+    metadata_db_size = 100000  # max amount of songs in the metadata store
+    metadata_max_age = 7 * 24 * 3600  # seconds stored metadata of a video is trusted without asking the youtube api
+    extract_backend = "thread"  # run yt-dlp/youtube_dl in "thread"s or in worker "process"es
+    extract_workers = 2  # max simultaneous yt-dlp/youtube_dl extractions
+    extract_timeout = 60  # seconds after which an extraction is treated as failed
+    prefetch_songs = 3  # amount of upcoming songs that get loaded in the background while a song is playing
+    autocomplete_size = 20000  # songs in the in-memory index which suggests songs while typing /play
+    autocomplete_history = 50  # played songs per guild which get suggested first
+    warm_keywords = False  # resolve the first song of the player_keywords after the start (instant first play)
+    audio_cache = False  # store the audio of often played songs on disk and play them from there
+    audio_cache_path = "VoDiPy_audio_cache"  # folder of the audio cache
+    audio_cache_size = 2 * 1024 ** 3  # max bytes of the audio cache (2 GiB)
+    audio_cache_min_plays = 3  # a song gets stored after it was played x times
+    audio_cache_max_duration = 20 * 60  # seconds, longer songs are not stored
+    audio_cache_policy = "lru"  # remove the least recently ("lru") or least often ("lfu") played songs if full
+    # send opus streams to discord without transcoding while the volume is 100%, with the default starting_volume
+    # this only happens after a user set the volume to 100%
+    opus_passthrough = True
+    gapless = False  # start the next song in the same frame the current one ends
+    gapless_prepare = 10  # seconds before the end of a song the next one gets loaded and buffered (gapless)
+    crossfade_ms = 0  # mix the end of a song with the start of the next one (gapless, not with opus passthrough)
+    volume_ramp_ms = 200  # volume changes fade over x ms (needs numpy)
+    metrics = False  # serve prometheus metrics on http://metrics_host:metrics_port/metrics
+    metrics_host = "127.0.0.1"
+    metrics_port = 9108  # shards use metrics_port + shard id
+    shards = 1  # gateway shards, >1 starts one process per shard which share the metadata db and resolved songs
     starting_volume = 0.1  # 10% volume
     max_volume = 1.0  # 100% volume
     # these people are allowed to use dj-restricted buttons (f.e. stop the bot)
@@ -31,3 +74,10 @@ class MusicPlayerStates:
     paused = 3
     on_next = 4  # skip & select
     exit = 5
+
+
+# don't edit this
+class MusicPlayerTimers:
+    paused = "paused"  # timeout_paused
+    empty = "empty"  # timeout_empty
+    new_dj = "new_dj"  # timeout_new_dj
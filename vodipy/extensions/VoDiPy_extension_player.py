@@ -1,14 +1,14 @@
-import asyncio
-from datetime import datetime
-
 from naff import Extension, listen, InteractionContext, OptionTypes, slash_option, slash_command, ComponentContext, \
-    prefixed_command, PrefixedContext
+    prefixed_command, PrefixedContext, AutocompleteContext
 from naff.api.events import VoiceStateUpdate
 
 from player.VoDiPy_player import case_command_play
 from player.VoDiPy_classes import MusicPlayer
 from VoDiPy_defines import MusicPlayerStates as MPStates
 from VoDiPy_defines import MusicPlayerSettings as MPSettings
+from VoDiPy_defines import MusicPlayerTimers as MPTimers
+from utils.VoDiPy_autocomplete import play_index
+from utils.VoDiPy_timers import timers
 
 
 class PlayerExtension(Extension):
@@ -29,11 +29,17 @@ class PlayerExtension(Extension):
         name="link",
         description="Link to youtube(video/playlist), soundcloud, ...",
         required=True,
-        opt_type=OptionTypes.STRING
+        opt_type=OptionTypes.STRING,
+        autocomplete=True
     )
     async def slash_player(self, ctx: InteractionContext, link):
         await case_command_play(ctx, link)
 
+    @slash_player.autocomplete("link")
+    async def autocomplete_link(self, ctx: AutocompleteContext, **kwargs):
+        """Suggest the songs played in this guild, keywords and known songs while typing"""
+        await ctx.send(play_index.search(ctx.input_text, ctx.guild_id))
+
     @listen()
     async def on_component(self, event):
         """Called on button press / select choice. Don't defer to prevent spamming."""
@@ -94,45 +100,44 @@ class PlayerExtension(Extension):
         if not event.after or (event.before and event.after):  # left voice
             # if dj left, check timeout
             if state.member.id == mp.dj.id:
-                time = datetime.now()
-                mp.timer_new_dj = time
-                await asyncio.sleep(MPSettings.timeout_new_dj)
-                if mp.timer_new_dj != time:
-                    return
-                mp.timer_new_dj = None
-
-            vc = self.bot.get_bot_voice_state(state.guild.id)
-
-            # if dj left, assign new dj
-            if state.member.id == mp.dj.id and len(vc.channel.voice_members) > 1:
-                for new_dj in vc.channel.voice_members:
-                    if not new_dj.bot:
-                        mp.dj = new_dj
-                        await mp.update_embed()
-                        break
+                timers.schedule(mp.guild_id, MPTimers.new_dj, MPSettings.timeout_new_dj,
+                                self.check_left_voice, mp, state.member.id)
             else:
-                # if dj left & channel empty remove dj
-                if state.member.id == mp.dj.id:
-                    mp.dj = None
-                    await mp.update_embed()
-
-                # if empty channel, check leave timeout
-                if MPSettings.leave_if_empty and vc and len(vc.channel.voice_members) == 1:
-                    time = datetime.now()
-                    mp.timer_empty = time
-                    await asyncio.sleep(MPSettings.timeout_empty)
-                    if mp.timer_empty == time:
-                        await mp.stop()
-                        mp.timer_empty = None
-                elif not vc and mp.state in [MPStates.playing, MPStates.on_next, MPStates.paused]:
-                    await mp.stop()
+                await self.check_left_voice(mp, state.member.id)
         else:  # joined voice
-            mp.timer_empty = None
+            timers.cancel(mp.guild_id, MPTimers.empty)
             if not mp.dj:
                 mp.dj = state.member
                 await mp.update_embed()
             elif mp.dj.id == state.member.id:
-                mp.timer_new_dj = None
+                timers.cancel(mp.guild_id, MPTimers.new_dj)
+
+    async def check_left_voice(self, mp: MusicPlayer, member_id: int):
+        """Assign a new dj or leave an empty channel after somebody left the voice channel
+
+        :param mp: the music player of the guild
+        :param member_id: the member who left
+        """
+        vc = self.bot.get_bot_voice_state(mp.guild_id)
+
+        # if dj left, assign new dj
+        if member_id == mp.dj.id and len(vc.channel.voice_members) > 1:
+            for new_dj in vc.channel.voice_members:
+                if not new_dj.bot:
+                    mp.dj = new_dj
+                    await mp.update_embed()
+                    break
+        else:
+            # if dj left & channel empty remove dj
+            if member_id == mp.dj.id:
+                mp.dj = None
+                await mp.update_embed()
+
+            # if empty channel, check leave timeout
+            if MPSettings.leave_if_empty and vc and len(vc.channel.voice_members) == 1:
+                timers.schedule(mp.guild_id, MPTimers.empty, MPSettings.timeout_empty, mp.stop)
+            elif not vc and mp.state in [MPStates.playing, MPStates.on_next, MPStates.paused]:
+                await mp.stop()
 
 
 def setup(client):
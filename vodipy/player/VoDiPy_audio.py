@@ -0,0 +1,413 @@
+import asyncio
+import audioop
+import importlib
+import queue
+import struct
+import subprocess
+import threading
+from typing import Union, Callable, Any
+
+from naff.api.voice.audio import BaseAudio, Audio, AudioVolume
+
+from VoDiPy_defines import MusicPlayerSettings as MPSettings
+
+
+OGG_PAGE_HEADER = struct.Struct("<4sBBqIIIB")  # capture pattern, version, type, granule, serial, seq, crc, segments
+OPUS_FRAME_MS = 20  # the voice player sends one packet every 20 ms
+# ms of one opus frame by configuration (toc >> 3), https://www.rfc-editor.org/rfc/rfc6716#section-3.1
+OPUS_CONFIG_MS = [10, 20, 40, 60] * 3 + [10, 20] * 2 + [2.5, 5, 10, 20] * 4
+np = None  # numpy gets imported by load_numpy in the warm-up or with the first song, False if it is not installed
+
+
+def load_numpy():
+    """Import numpy if it is installed
+
+    :return: False if numpy is not installed
+    """
+    global np
+    if np is None:
+        try:
+            np = importlib.import_module("numpy")
+        except ImportError:
+            np = False
+    return np is not False
+
+
+def get_opus_packet_ms(packet: bytes):
+    """Get the duration of an opus packet from its toc byte"""
+    frames = [1, 2, 2, packet[1] & 0x3F if len(packet) > 1 else 0][packet[0] & 0x03]
+    return OPUS_CONFIG_MS[packet[0] >> 3] * frames
+
+
+class NumpyVolumeAudio(AudioVolume):
+    """AudioVolume which processes the 20 ms frames with numpy
+
+    Volume changes are ramped linearly over volume_ramp_ms instead of jumping, and a peak limiter lowers the gain
+    before samples would clip. All buffers of a frame are allocated once and reused.
+    """
+    limit = 32767 * 0.98  # highest sample value after the gain
+    release_frames = 25  # frames (0.5s) the limiter needs to go back to full gain
+
+    def __init__(self, src: str):
+        super().__init__(src)
+        load_numpy()
+        self._gain = self._volume  # volume at the end of the last frame, moves towards the volume
+        self._step = 0.0  # volume change per frame while ramping
+        self._limiter = 1.0  # gain of the peak limiter
+        self._applied = self._volume  # gain (volume * limiter) at the end of the last frame
+        self._size = 0
+        self._ramp = self._gains = self._samples = self._out = None
+
+    @property
+    def volume(self) -> float:
+        return self._volume
+
+    @volume.setter
+    def volume(self, value: float) -> None:
+        self._volume = max(value, 0.0)
+        if not self._size:  # nothing was played yet, start with this volume
+            self._gain = self._applied = self._volume
+            return
+        frames = max(MPSettings.volume_ramp_ms // 20, 1)
+        self._step = (self._volume - self._gain) / frames
+
+    def _allocate(self, size: int):
+        """Create the buffers for frames of size bytes (16 bit stereo)"""
+        self._size = size
+        samples = size // 2
+        # position of every sample in the frame (0 -> 1), both channels of a sample share it
+        self._ramp = np.repeat(np.arange(1, samples // 2 + 1, dtype=np.float32) / (samples // 2), 2)
+        self._gains = np.empty(samples, dtype=np.float32)
+        self._samples = np.empty(samples, dtype=np.float32)
+        self._out = np.empty(samples, dtype=np.int16)
+
+    def apply_gain(self, data: bytes) -> bytes:
+        """Apply gain ramp and limiter to a frame of 16 bit stereo pcm"""
+        if len(data) != self._size:
+            self._allocate(len(data))
+        pcm = np.frombuffer(data, dtype=np.int16)
+        if self._step and abs(self._volume - self._gain) > abs(self._step):
+            self._gain += self._step
+        else:
+            self._gain, self._step = self._volume, 0.0
+        start, end = self._applied, self._gain * self._limiter
+        if start == end:
+            np.multiply(pcm, end, out=self._samples)
+        else:
+            np.multiply(self._ramp, end - start, out=self._gains)
+            self._gains += start
+            np.multiply(pcm, self._gains, out=self._samples)
+        # a gain below limit / 32768 cannot clip, the peak search is skipped then
+        peak = max(self._samples.max(), -self._samples.min()) if max(start, end) * 32768 > self.limit else 0
+        if peak > self.limit:  # attack at once, the frame itself gets scaled down
+            reduction = self.limit / peak
+            self._samples *= reduction
+            self._limiter *= reduction
+            end *= reduction
+        elif self._limiter < 1.0:  # gets ramped in the next frame
+            self._limiter = min(self._limiter + 1 / self.release_frames, 1.0)
+        self._applied = end
+        np.copyto(self._out, self._samples, casting="unsafe")
+        return self._out.tobytes()
+
+    def read(self, frame_size: int) -> bytes:
+        data = Audio.read(self, frame_size)
+        return self.apply_gain(data) if data else data
+
+
+def create_volume_audio(src: str) -> AudioVolume:
+    """Get an AudioVolume, processed with numpy if it is installed"""
+    return NumpyVolumeAudio(src) if load_numpy() else AudioVolume(src)
+
+
+class OggOpusReader:
+    """Copies the opus stream of a source into an ogg container with ffmpeg and splits it into packets"""
+    buffer_packets = 150  # 3s
+
+    def __init__(self, src: str, before_args: str = "", start: float = 0):
+        cmd = ["ffmpeg", *before_args.split()]
+        if start:
+            cmd += ["-ss", f"{start:.2f}"]
+        cmd += ["-i", src, "-map", "0:a:0", "-vn", "-c:a", "copy", "-f", "ogg", "-loglevel", "warning", "pipe:1"]
+        self.process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                        stdin=subprocess.DEVNULL)
+        self.packets: queue.Queue[bytes] = queue.Queue(self.buffer_packets)
+        self.ready = threading.Event()  # set when the buffer is full or the source ended
+        self.ended = False
+        self.unsupported = False  # the packets are not 20 ms long, they can't be sent as they are
+        self.seeked = bool(start)
+        threading.Thread(target=self._read_ahead, daemon=True).start()
+
+    def _read_ahead(self):
+        stdout = self.process.stdout
+        partial = b""
+        try:
+            while header := stdout.read(OGG_PAGE_HEADER.size):
+                if len(header) < OGG_PAGE_HEADER.size or header[:4] != b"OggS":
+                    break
+                _, _, _, granule, _, _, _, segments = OGG_PAGE_HEADER.unpack(header)
+                lacing = stdout.read(segments)
+                data = stdout.read(sum(lacing))
+                pos = 0
+                completed = []
+                for size in lacing:
+                    partial += data[pos:pos + size]
+                    pos += size
+                    if size == 255:  # the packet continues in the next segment
+                        continue
+                    packet, partial = partial, b""
+                    if packet and not packet.startswith((b"OpusHead", b"OpusTags")):
+                        completed.append(packet)
+                for i, packet in enumerate(completed):
+                    # ffmpeg seeks to the cluster before the position, its granules are relative to the position
+                    if self.seeked and granule - (len(completed) - 1 - i) * OPUS_FRAME_MS * 48 <= 0:
+                        continue
+                    if get_opus_packet_ms(packet) != OPUS_FRAME_MS:
+                        self.unsupported = True
+                    self.packets.put(packet)
+                    if self.packets.full():
+                        self.ready.set()
+        except (ValueError, OSError):  # cleanup closed the pipe
+            pass
+        finally:
+            self.ended = True
+            self.ready.set()
+
+    @property
+    def audio_complete(self):
+        return self.ended and self.packets.empty()
+
+    def read(self, frame_size: int = None):
+        self.ready.wait()
+        try:
+            return self.packets.get_nowait()
+        except queue.Empty:
+            return b""
+
+    def skip(self, frames: int):
+        for _ in range(frames):
+            if not self.read():
+                break
+
+    def cleanup(self):
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        self.process.stdout.close()
+        while not self.packets.empty():  # unblock the read ahead thread
+            self.packets.get_nowait()
+
+
+class OpusPassthroughAudio(BaseAudio):
+    """Audio which sends the opus packets of the source to discord without decoding and encoding them again
+
+    Discord cannot change the volume of a stream, so while the volume is not 100% the source gets decoded and
+    scaled (AudioVolume) like before. Switching starts a new ffmpeg process at the current position, the player
+    keeps sending the old one until the new one has buffered.
+    """
+
+    def __init__(self, src: str, before_args: str = "", volume: float = 1.0):
+        self.source = src
+        self.ffmpeg_before_args = before_args
+        self.locked_stream = False
+        self.needs_encode = False
+        self._volume = max(volume, 0.0)
+        self._frames = 0  # read frames, 20 ms each
+        self._lock = threading.Lock()
+        self._current: Union[OggOpusReader, AudioVolume, None] = None
+        self._next: Union[tuple[Union[OggOpusReader, AudioVolume], int], None] = None  # (source, start frame)
+        self._force_decode = False
+
+    def __repr__(self):
+        return f"<{type(self).__name__}: {self.source}>"
+
+    @property
+    def passthrough(self):
+        """If the opus packets should be sent as they are"""
+        return self._volume == 1.0 and not self._force_decode
+
+    @property
+    def volume(self):
+        return self._volume
+
+    @volume.setter
+    def volume(self, value: float):
+        """Called by naff when the volume of the voice state changes"""
+        with self._lock:
+            self._volume = max(value, 0.0)
+            if isinstance(self._current, AudioVolume):
+                self._current.volume = self._volume
+            if self._current:
+                self._switch()
+
+    @property
+    def audio_complete(self):
+        return not self._current or self._current.audio_complete
+
+    def _open(self, passthrough: bool, start_frame: int):
+        start = start_frame * OPUS_FRAME_MS / 1000
+        if passthrough:
+            return OggOpusReader(self.source, self.ffmpeg_before_args, start)
+        audio = create_volume_audio(self.source)
+        audio.ffmpeg_before_args = f"{self.ffmpeg_before_args} -ss {start:.2f}" if start else self.ffmpeg_before_args
+        audio.volume = self._volume
+        audio.pre_buffer()
+        return audio
+
+    def pre_buffer(self):
+        """Start ffmpeg before the first frame gets read"""
+        with self._lock:
+            if not self._current:
+                self._current = self._open(self.passthrough, 0)
+
+    def _switch(self):
+        """Start the process for the wanted mode if it is not running yet, needs the lock"""
+        wanted = self.passthrough
+        upcoming = isinstance(self._next[0], OggOpusReader) if self._next else isinstance(self._current, OggOpusReader)
+        if wanted == upcoming:
+            return
+        if self._next:  # the volume changed back before the new process was ready
+            self._next[0].cleanup()
+            self._next = None
+        if wanted != isinstance(self._current, OggOpusReader):
+            self._next = (self._open(wanted, self._frames), self._frames)
+
+    def read(self, frame_size: int) -> bytes:
+        """Read the next frame, opus packet (needs_encode False) or pcm data (needs_encode True)"""
+        with self._lock:
+            if not self._current:
+                self._current = self._open(self.passthrough, 0)
+            elif self._next:
+                source, start_frame = self._next
+                if isinstance(source, OggOpusReader) and source.ready.is_set() \
+                        or isinstance(source, AudioVolume) and source.buffer.initialised.is_set():
+                    self._current.cleanup()
+                    self._current, self._next = source, None
+                    # skip what was played while the new process started
+                    skip = self._frames - start_frame
+                    if isinstance(source, OggOpusReader):
+                        source.skip(skip)
+                    elif skip > 0:
+                        source.buffer.read(frame_size * skip)
+            elif isinstance(self._current, OggOpusReader) and self._current.unsupported and not self._force_decode:
+                self._force_decode = True
+                self._switch()
+            source = self._current
+            self.needs_encode = isinstance(source, AudioVolume)
+        data = source.read(frame_size)
+        if data:
+            self._frames += 1
+        return data
+
+    def cleanup(self):
+        with self._lock:
+            for source in (self._current, self._next[0] if self._next else None):
+                if source:
+                    source.cleanup()
+
+
+class GaplessAudio(BaseAudio):
+    """Plays songs after each other in one run of the voice player, so there is no gap between them
+
+    prepare_seconds before the current song ends, prepare(self) gets called in the event loop, it can hand over the
+    audio of the next song with set_next. The next audio starts in the same frame the current one ends, or both get
+    mixed over crossfade_ms if they are pcm. started(tag) gets called in the event loop when the next song started.
+    """
+
+    def __init__(self, audio: BaseAudio, duration: int, loop: asyncio.AbstractEventLoop,
+                 prepare: Callable[["GaplessAudio"], Any], started: Callable[[Any], Any]):
+        self.locked_stream = False
+        self.needs_encode = audio.needs_encode
+        self.closed = False
+        self._loop = loop
+        self._prepare = prepare
+        self._started = started
+        self._lock = threading.Lock()
+        self._current = audio
+        self._duration_frames = duration * 1000 // OPUS_FRAME_MS  # 0: unknown/stream, nothing gets prepared
+        self._frames = 0  # read frames of the current audio
+        self._next: Union[tuple[BaseAudio, int, Any], None] = None  # (audio, duration, tag)
+        self._next_frames = 0  # read frames of the next audio while crossfading
+        self._prepared = False
+        self._fade_frames = MPSettings.crossfade_ms // OPUS_FRAME_MS
+        self._prepare_frames = max(MPSettings.gapless_prepare * 1000 // OPUS_FRAME_MS, self._fade_frames)
+
+    def __repr__(self):
+        return f"<{type(self).__name__}: {self._current!r}>"
+
+    @property
+    def volume(self):
+        return getattr(self._current, "volume", 1.0)
+
+    @volume.setter
+    def volume(self, value: float):
+        with self._lock:
+            for audio in (self._current, self._next[0] if self._next else None):
+                if audio and hasattr(audio, "volume"):
+                    audio.volume = value
+
+    @property
+    def audio_complete(self):
+        return self._current.audio_complete and not self._next
+
+    def set_next(self, audio: BaseAudio, duration: int, tag: Any = None):
+        """Set the audio which continues when the current one ends
+
+        :param audio: audio of the next song
+        :param duration: seconds of the next song, 0 if unknown
+        :param tag: gets passed to started
+        """
+        with self._lock:
+            if self.closed:
+                audio.cleanup()
+                return
+            if self._next:
+                self._next[0].cleanup()
+            self._next = (audio, duration, tag)
+            self._next_frames = 0
+        if hasattr(audio, "pre_buffer"):  # start ffmpeg now, the first frames are needed without delay
+            audio.pre_buffer()
+
+    def _crossfading(self):
+        return self._fade_frames and self._duration_frames and self._current.needs_encode \
+            and self._next[0].needs_encode and self._frames >= self._duration_frames - self._fade_frames
+
+    def read(self, frame_size: int) -> bytes:
+        with self._lock:
+            if not self._prepared and self._duration_frames \
+                    and self._frames >= self._duration_frames - self._prepare_frames:
+                self._prepared = True
+                self._loop.call_soon_threadsafe(self._prepare, self)
+            data = self._current.read(frame_size)
+            if data:
+                self._frames += 1
+            fade_data = b""
+            if self._next and self._crossfading():
+                fade_data = self._next[0].read(frame_size)
+                if fade_data:
+                    self._next_frames += 1
+                    if data:
+                        fade_in = min(self._next_frames / self._fade_frames, 1.0)
+                        data = audioop.add(audioop.mul(data, 2, 1.0 - fade_in), audioop.mul(fade_data, 2, fade_in), 2)
+            if not data and self._next and self._current.audio_complete:
+                # the current song ended, the next one continues in this frame
+                self._current.cleanup()
+                self._current, duration, tag = self._next
+                self._next = None
+                self._duration_frames = duration * 1000 // OPUS_FRAME_MS
+                self._frames, self._next_frames = self._next_frames, 0
+                self._prepared = False
+                self._loop.call_soon_threadsafe(self._started, tag)
+                data = fade_data or self._current.read(frame_size)
+                if data and not fade_data:
+                    self._frames += 1
+            self.needs_encode = self._current.needs_encode
+        return data
+
+    def cleanup(self):
+        with self._lock:
+            self.closed = True
+            self._current.cleanup()
+            if self._next:
+                self._next[0].cleanup()
+                self._next = None
@@ -1,182 +1,676 @@
 import asyncio
 import random
-from datetime import timedelta, datetime
-from typing import Union
+import sys
+import time
+from bisect import bisect_right
+from datetime import timedelta
+from typing import Union, Iterator
 
 from naff import Embed, Member, ActionRow, Button, ButtonStyles, \
     Select, SelectOption, ComponentContext, Message, Client
-from naff.api.voice.audio import AudioVolume
 from naff.client.errors import NotFound, VoiceConnectionTimeout, VoiceWebSocketClosed
 
 from VoDiPy_defines import MusicPlayerSettings as MPSettings
 from VoDiPy_defines import MusicPlayerStates as MPStates
-from utils.VoDiPy_api import yt_dl_data
+from VoDiPy_defines import MusicPlayerTimers as MPTimers
+from player.VoDiPy_audio import OpusPassthroughAudio, GaplessAudio, create_volume_audio
+from utils.VoDiPy_api import yt_dl_data, yt_api_videos_data, yt_api_parse_duration, yt_api_is_playable, \
+    YtApiUnavailable
+from utils.VoDiPy_audiocache import audio_cache
+from utils.VoDiPy_autocomplete import play_index
+from utils.VoDiPy_cache import stream_cache, get_stream_deadline, get_cache_key
+from utils.VoDiPy_extract import extraction_engine
+from utils.VoDiPy_metadata import metadata_store
+from utils.VoDiPy_metrics import metrics
+from utils.VoDiPy_timers import timers
 from utils.VoDiPy_utils import get_next_seq, can_join_voice
 
 
+YT_WATCH_URL = "https://www.youtube.com/watch?v="
+YT_PLAYLIST_URL = "https://www.youtube.com/playlist?list="
+YT_THUMBNAIL_URL = "https://i.ytimg.com/vi/{}/hqdefault.jpg"
+YT_UNAVAILABLE_TITLES = ("[Private video]", "[Deleted video]")  # titles of flat playlist entries which can't be played
+
+
 class MusicPlayerQueueSong:
-    loaded = False
-    error = False
-    private = False
-    duration = "loading..."
-    title = ""
-    uploader = ""
-    desc = ""
-    stream_url = ""
-    thumbnail = ""
+    """A song of the queue
+
+    Only ids are stored for YouTube songs, the urls get built when needed. Repeated strings (uploader, playlist)
+    are interned, so all songs of a playlist share them.
+    """
+    __slots__ = ("song_id", "video_id", "source_url", "playlist_id", "source_playlist_url", "playlist_pos",
+                 "title", "uploader", "seconds", "thumbnail_url", "stream_url", "stream_deadline",
+                 "loaded", "error", "private", "opus")
     text_width = 50
 
     def __init__(self, entry_yt_api=None, entry_yt_dl=None, video_url=None, playlist_url=None, playlist_pos=None):
         assert (entry_yt_api or entry_yt_dl or video_url or (playlist_url and playlist_pos and playlist_pos != 0))
         self.song_id = get_next_seq()
+        self.video_id: Union[str, None] = None  # YouTube video id
+        self.source_url: Union[str, None] = None  # video url of other sources
+        self.playlist_id: Union[str, None] = None  # YouTube playlist id
+        self.source_playlist_url: Union[str, None] = None  # playlist url of other sources
+        self.playlist_pos = playlist_pos
+        self.title = ""
+        self.uploader = ""
+        self.seconds: Union[int, None] = None  # duration, 0: stream, None: unknown
+        self.thumbnail_url: Union[str, None] = None  # only set if it differs from the default YouTube thumbnail
+        self.stream_url = ""
+        self.stream_deadline = 0.0  # timestamp until the stream_url can be used
+        self.loaded = False
+        self.error = False
+        self.private = False
+        self.opus = False  # the stream is 48 kHz opus, it can be sent to discord without transcoding
         self.video_url = video_url
         self.playlist_url = playlist_url
-        self.playlist_pos = playlist_pos
         if entry_yt_api:
             self.process_data_yt_api(entry_yt_api)
         elif entry_yt_dl:
             self.process_data_yt_dl(entry_yt_dl)
 
-    async def load_data(self):
-        """Download the song data"""
+    @property
+    def video_url(self):
+        return YT_WATCH_URL + self.video_id if self.video_id else self.source_url
+
+    @video_url.setter
+    def video_url(self, url):
+        key = get_cache_key(url) if url else ""
+        if key.startswith("youtube:"):
+            self.video_id, self.source_url = key[8:], None
+        else:
+            self.video_id, self.source_url = None, url
+
+    @property
+    def playlist_url(self):
+        return YT_PLAYLIST_URL + self.playlist_id if self.playlist_id else self.source_playlist_url
+
+    @playlist_url.setter
+    def playlist_url(self, url):
+        if url and url.startswith(YT_PLAYLIST_URL):
+            self.playlist_id, self.source_playlist_url = sys.intern(url[len(YT_PLAYLIST_URL):]), None
+        else:
+            self.playlist_id, self.source_playlist_url = None, sys.intern(url) if url else None
+
+    @property
+    def thumbnail(self):
+        if self.thumbnail_url:
+            return self.thumbnail_url
+        return YT_THUMBNAIL_URL.format(self.video_id) if self.video_id else ""
+
+    @thumbnail.setter
+    def thumbnail(self, url):
+        self.thumbnail_url = url if url != self.thumbnail else None
+
+    @property
+    def duration(self):
+        if self.seconds is None:
+            return "loading..."
+        return str(timedelta(seconds=self.seconds)) if self.seconds > 0 else "Stream"
+
+    @property
+    def desc(self):
+        return self.uploader if self.seconds is None else f"{self.uploader} - {self.duration}"
+
+    def _shorten(self, text: str):
+        return text if len(text) < self.text_width else (text[:self.text_width] + "...")
+
+    @property
+    def extract_link(self):
+        """The link yt-dlp/youtube_dl loads, the video_url is preferred"""
+        return self.video_url if self.video_url else self.playlist_url
+
+    async def load_data(self, guild_id: int = None, background: bool = False):
+        """Download the song data
+
+        :param guild_id: the guild which wants to play the song
+        :param background: nobody waits for the song yet (prefetch)
+        """
         if self.private or self.error or self.loaded:
             return
-        # prefer video_url when downloading
-        data = await yt_dl_data(self.video_url if self.video_url else self.playlist_url, self.playlist_pos)
+        if self.video_url and self.title and audio_cache.get(get_cache_key(self.video_url)):
+            if self.seconds is None:
+                self.hydrate()
+            if self.seconds is not None and not self.error:
+                # played from the audio cache, create_audio resolves the stream url if the file is gone by then
+                self.stream_deadline = 0.0
+                self.loaded = True
+                return
+        link = self.extract_link
+        if data := stream_cache.get(link, None if self.video_url else self.playlist_pos):
+            self.process_data_yt_dl(data)
+            return
+        data = await yt_dl_data(link, self.playlist_pos, guild_id, background)
+        if data and data.get("entries"):  # loaded by playlist position
+            data = data["entries"][0]
         if not data:
             self.error = True
         else:
+            stream_cache.put(data, link, None if self.video_url else self.playlist_pos)
             self.process_data_yt_dl(data)
 
+    async def reload_data(self, guild_id: int = None):
+        """Download the song data again if the stream url expired
+
+        :param guild_id: the guild which wants to play the song
+        """
+        if self.loaded and self.stream_deadline <= time.time():
+            self.loaded = False
+            await self.load_data(guild_id)
+
+    def hydrate(self, max_age: float = None, recheck: bool = False):
+        """Fill the song with data from the metadata store, without a network call
+
+        :param max_age: ignore stored data which is older than x seconds
+        :param recheck: ignore a stored "unplayable", the song gets checked again (region, upcoming, processing)
+        :return: True if the song was found
+        """
+        entry = metadata_store.get(get_cache_key(self.video_url), max_age)
+        if not entry:
+            return False
+        if entry["privacy"] and entry["privacy"] != "public" and not (recheck and entry["privacy"] == "unplayable"):
+            self.error = True
+            self.private = True
+            return True
+        if entry["title"]:
+            self.title = self._shorten(entry["title"])
+        if entry["uploader"]:
+            self.uploader = sys.intern(self._shorten(entry["uploader"]))
+        if entry["duration"] is not None:
+            self.seconds = entry["duration"]
+        if entry["thumbnail"]:
+            self.thumbnail = entry["thumbnail"]
+        return True
+
     def process_data_yt_api(self, entry):
         """Fill Song with data received from the youtube api"""
+        if "playlistItem" in entry["kind"]:
+            self.video_id = entry["snippet"]["resourceId"]["videoId"]
+        else:
+            self.video_id = entry["id"]
         if entry["status"]["privacyStatus"] != "public":
+            metadata_store.put(get_cache_key(self.video_url), privacy=entry["status"]["privacyStatus"])
             self.error = True
             self.private = True
             return
-        self.title = entry["snippet"]["title"] if len(entry["snippet"]["title"]) < self.text_width \
-            else (entry["snippet"]["title"][:self.text_width] + "...")
+        title = entry["snippet"]["title"]
+        self.title = self._shorten(title)
         if "playlistItem" in entry["kind"]:
             uploader = entry["snippet"]["videoOwnerChannelTitle"]
-            self.video_url = "https://www.youtube.com/watch?v=" + entry["snippet"]["resourceId"]["videoId"]
-            self.playlist_url = "https://www.youtube.com/playlist?list=" + entry["snippet"].get("playlistId")
+            self.playlist_id = sys.intern(entry["snippet"].get("playlistId"))
             self.playlist_pos = entry["snippet"].get("position")
         else:
             uploader = entry["snippet"]["channelTitle"]
-            self.video_url = "https://www.youtube.com/watch?v=" + entry["id"]
-        self.uploader = uploader if len(uploader) < self.text_width else (uploader[:self.text_width] + "...")
-        self.desc = self.uploader
+        self.uploader = sys.intern(self._shorten(uploader))
+        thumbnails = entry["snippet"].get("thumbnails")
+        thumbnail = next((thumbnails[size]["url"] for size in ["high", "medium", "default"]
+                          if thumbnails and size in thumbnails), None)
+        duration = None
+        privacy = None  # the status of a playlistItem is not the status of the video, keep the stored one
+        if "contentDetails" in entry and "duration" in entry["contentDetails"]:  # videos.list
+            duration = 0 if entry["snippet"].get("liveBroadcastContent") == "live" \
+                else yt_api_parse_duration(entry["contentDetails"]["duration"])
+            privacy = "public" if yt_api_is_playable(entry) else "unplayable"
+        metadata_store.put(get_cache_key(self.video_url), title=title, uploader=uploader, duration=duration,
+                           thumbnail=thumbnail, privacy=privacy)
+        if privacy != "unplayable":
+            play_index.add(self.video_url, title, uploader)
+        # playlist items don't contain the duration, maybe it is known already
+        self.hydrate(MPSettings.metadata_max_age, recheck=privacy is None)
+
+    def process_data_yt_dl_flat(self, entry):
+        """Fill song with an entry of a flat playlist from yt-dlp/youtube_dl, the song still has to be loaded"""
+        url = entry.get("url") or entry.get("webpage_url") or ""
+        if entry.get("ie_key") == "Youtube" and not url.startswith("http"):  # youtube_dl only has the id
+            url = YT_WATCH_URL + url
+        self.video_url = url
+        title = entry.get("title") or url
+        if title in YT_UNAVAILABLE_TITLES:
+            self.error = True
+            self.private = True
+            return
+        uploader = entry.get("uploader") or entry.get("channel") or ""
+        self.title = self._shorten(title)
+        self.uploader = sys.intern(self._shorten(uploader))
+        duration = int(entry["duration"]) if entry.get("duration") else None
+        metadata_store.put(get_cache_key(self.video_url), title=title, uploader=uploader or None, duration=duration)
+        self.hydrate(MPSettings.metadata_max_age, recheck=True)  # yt-dlp checks the song when it is loaded
 
     def process_data_yt_dl(self, entry):
         """Fill song with data received from yt-dlp/youtube_dl, song is 'loaded' in this case"""
-        self.title = entry["title"] if len(entry["title"]) < self.text_width \
-            else (entry["title"][:self.text_width] + "...")
-        self.uploader = entry["uploader"] if len(entry["uploader"]) < self.text_width \
-            else (entry["uploader"][:self.text_width] + "...")
-        self.duration = str(timedelta(seconds=int(entry["duration"]))) \
-            if entry.get("duration") and entry["duration"] > 0 else "Stream"
-        self.desc = self.uploader + " - " + self.duration
+        self.title = self._shorten(entry["title"])
+        self.uploader = sys.intern(self._shorten(entry["uploader"]))
+        self.seconds = int(entry["duration"]) if entry.get("duration") and entry["duration"] > 0 else 0
         self.video_url = entry["webpage_url"]
         self.stream_url = entry["url"]
+        self.stream_deadline = get_stream_deadline(entry)
+        self.opus = entry.get("acodec") == "opus" and entry.get("asr", 48000) == 48000
         if entry.get("thumbnail"):
             self.thumbnail = entry["thumbnail"]
         else:
             self.thumbnail = entry["thumbnails"][0]["url"]
         self.loaded = True
+        metadata_store.put(get_cache_key(self.video_url), title=entry["title"], uploader=entry["uploader"],
+                           duration=self.seconds, thumbnail=self.thumbnail, privacy="public")
+        play_index.add(self.video_url, entry["title"], entry["uploader"])
+
+
+class SongSequence:
+    """The songs of a queue in order, stored in blocks
+
+    Looking up the position of a song_id and inserting in the middle only touch one block and the block offsets,
+    so they don't get slower with every song like on a plain list. Appending is O(1).
+    """
+    block_size = 256
+
+    def __init__(self):
+        self._blocks: list[list[MusicPlayerQueueSong]] = []
+        self._offsets: list[int] = []  # position of the first song of every block
+        self._songs: dict[int, MusicPlayerQueueSong] = {}  # {song_id: song}
+        self._block_of: dict[int, list[MusicPlayerQueueSong]] = {}  # {song_id: block}
+        self._block_index: dict[int, int] = {}  # {id(block): index of the block}
+
+    def __len__(self):
+        return len(self._songs)
+
+    def __iter__(self) -> Iterator[MusicPlayerQueueSong]:
+        for block in self._blocks:
+            yield from block
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            start, stop, step = item.indices(len(self))
+            assert step == 1
+            return list(self._iter_from(start, stop - start))
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < len(self):
+            raise IndexError("song position out of range")
+        index = bisect_right(self._offsets, item) - 1
+        return self._blocks[index][item - self._offsets[index]]
+
+    def _iter_from(self, pos: int, count: int):
+        """Iterate over count songs starting at pos"""
+        if count <= 0:
+            return
+        index = bisect_right(self._offsets, pos) - 1
+        offset = pos - self._offsets[index]
+        for block in self._blocks[index:]:
+            for song in block[offset:]:
+                yield song
+                count -= 1
+                if count == 0:
+                    return
+            offset = 0
+
+    def get(self, song_id: int):
+        """Get a song by its song_id, None if it isn't in the queue"""
+        return self._songs.get(song_id)
+
+    def index(self, song_id: int):
+        """Get the position of a song_id, None if it isn't in the queue"""
+        song = self._songs.get(song_id)
+        if not song:
+            return None
+        block = self._block_of[song_id]
+        return self._offsets[self._block_index[id(block)]] + block.index(song)
+
+    def append(self, song: MusicPlayerQueueSong):
+        if not self._blocks or len(self._blocks[-1]) >= self.block_size:
+            self._offsets.append(len(self))
+            self._block_index[id(block := [])] = len(self._blocks)
+            self._blocks.append(block)
+        self._blocks[-1].append(song)
+        self._songs[song.song_id] = song
+        self._block_of[song.song_id] = self._blocks[-1]
+
+    def insert(self, pos: int, song: MusicPlayerQueueSong):
+        """Insert a song before pos, appends if pos is after the last song"""
+        if pos >= len(self) or not self._blocks:
+            self.append(song)
+            return
+        index = bisect_right(self._offsets, max(pos, 0)) - 1
+        block = self._blocks[index]
+        block.insert(max(pos, 0) - self._offsets[index], song)
+        self._songs[song.song_id] = song
+        self._block_of[song.song_id] = block
+        for i in range(index + 1, len(self._offsets)):
+            self._offsets[i] += 1
+        if len(block) >= 2 * self.block_size:
+            self._split(index)
+
+    def _split(self, index: int):
+        """Split a full block in two halves"""
+        block = self._blocks[index]
+        new_block = block[self.block_size:]
+        del block[self.block_size:]
+        self._blocks.insert(index + 1, new_block)
+        self._offsets.insert(index + 1, self._offsets[index] + len(block))
+        for song in new_block:
+            self._block_of[song.song_id] = new_block
+        self._block_index = {id(b): i for i, b in enumerate(self._blocks)}
+
+    def clear(self):
+        self._blocks.clear()
+        self._offsets.clear()
+        self._songs.clear()
+        self._block_of.clear()
+        self._block_index.clear()
+
+
+class ShuffleDeck:
+    """The precomputed play order of a queue in shuffle mode
+
+    The song_ids of the songs which weren't played in this round are shuffled once (Fisher-Yates), the next song is
+    at the end. Songs which are added while playing get a random place without touching the next `keep` songs,
+    so the upcoming order stays valid for the prefetcher.
+    """
+
+    def __init__(self):
+        self._deck: list[int] = []
+
+    def __len__(self):
+        return len(self._deck)
+
+    def reset(self, song_ids):
+        """Start a new round with these songs"""
+        self._deck = list(song_ids)
+        random.shuffle(self._deck)
+
+    def add(self, song_id: int, keep: int = 0):
+        """Add a song at a random place after the next `keep` songs (inside-out Fisher-Yates step)"""
+        kept = self._deck[max(len(self._deck) - keep, 0):] if keep else []
+        del self._deck[len(self._deck) - len(kept):]
+        self._deck.append(song_id)
+        pos = random.randint(0, len(self._deck) - 1)
+        self._deck[pos], self._deck[-1] = self._deck[-1], self._deck[pos]
+        self._deck.extend(kept)
+
+    def add_next(self, song_id: int):
+        """Add a song which should be played next"""
+        self._deck.append(song_id)
+
+    def draw(self, songs: SongSequence):
+        """Take the next playable song, songs with errors or which got removed are skipped"""
+        while self._deck:
+            song = songs.get(self._deck.pop())
+            if song and not song.error:
+                return song
+        return None
+
+    def upcoming(self, songs: SongSequence, count: int):
+        """Get the next playable songs without taking them"""
+        upcoming = []
+        for song_id in reversed(self._deck):
+            if len(upcoming) >= count:
+                break
+            if (song := songs.get(song_id)) and not song.error:
+                upcoming.append(song)
+        return upcoming
+
+    def clear(self):
+        self._deck.clear()
 
 
 class MusicPlayerQueue:
-    songs: list[MusicPlayerQueueSong] = []  # song queue in order
-    queue_pos = 0  # current position in queue
-    shuffle = False
-
-    def add_yt_api_dummies(self, data):
-        """Fill the queue with unloaded dummy songs"""
-        for song_data in data["items"]:
-            song = MusicPlayerQueueSong(entry_yt_api=song_data)
-            if len(data["items"]) == 1:
-                if not song.private:
-                    self.songs.insert(1 if len(self.songs) == 0 else self.queue_pos + 1, song)
-            else:
-                if not song.private:
-                    self.songs.append(song)
+    def __init__(self):
+        self.songs = SongSequence()  # song queue in order
+        self.queue_pos = 0  # current position in queue
+        self.shuffle = False
+        self.shuffle_deck = ShuffleDeck()  # play order in shuffle mode
+        self.prefetch_tasks: dict[int, asyncio.Task] = {}  # {song_id: Task}
+        # background producers which add songs to the queue: {task: songs it will still add}
+        self.loader_tasks: dict[asyncio.Task, int] = {}
+        self.guild_id: Union[int, None] = None
+
+    @property
+    def pending_songs(self):
+        """Songs the loader_tasks will add"""
+        return sum(self.loader_tasks.values())
+
+    def add_yt_api_dummies(self, data, play_next=None):
+        """Fill the queue with unloaded dummy songs
+
+        :param data: youtube api response
+        :param play_next: insert the song after the current song, default: if it is a single song
+        """
+        if play_next is None:
+            play_next = len(data["items"]) == 1
+        songs = []
+        with metadata_store.batch():
+            for song_data in data["items"]:
+                song = MusicPlayerQueueSong(entry_yt_api=song_data)
+                if not song.private and not (play_next and song.error):
+                    self._add_song(song, play_next)
+                    songs.append(song)
+        return songs
+
+    @staticmethod
+    async def enrich_songs(songs: list[MusicPlayerQueueSong]):
+        """Fill unloaded YouTube songs with duration, thumbnail and playability, 50 songs per youtube api request
+
+        Songs which cannot be played get marked with an error, so no extraction is wasted on them.
+        """
+        songs = [song for song in songs if song.video_id and not song.loaded and not song.error]
+        for i in range(0, len(songs), 50):
+            batch = songs[i:i + 50]
+            try:
+                items = await yt_api_videos_data([song.video_id for song in batch])
+            except YtApiUnavailable:  # the songs get checked when they are loaded
+                return
+            if items is None:  # api error, keep the songs as they are
+                continue
+            items = {item["id"]: item for item in items}
+            with metadata_store.batch():
+                for song in batch:
+                    if song.loaded:
+                        continue
+                    elif item := items.get(song.video_id):
+                        song.process_data_yt_api(item)
+                    else:  # deleted or private
+                        song.error = True
 
     def add_yt_dl_songs(self, data):
         """Fill the queue with data received from yt-dlp/youtube_dl (also non-YouTube)"""
         if not data.get("entries") or len(data["entries"]) == 1:
+            stream_cache.put(data)
             song = MusicPlayerQueueSong(entry_yt_dl=data)
             if not song.private:
-                self.songs.insert(1 if len(self.songs) == 0 else self.queue_pos + 1, song)
+                self._add_song(song, play_next=True)
         else:
-            for song_data in data["entries"]:
-                song = MusicPlayerQueueSong(entry_yt_dl=song_data)
-                if not song.private:
-                    self.songs.append(song)
+            with metadata_store.batch():
+                for song_data in data["entries"]:
+                    stream_cache.put(song_data)
+                    song = MusicPlayerQueueSong(entry_yt_dl=song_data)
+                    if not song.private:
+                        self._add_song(song, play_next=False)
 
-    async def get_next_song(self, increment=True, tries=0, check_loaded=False):
-        """Get the next song from the queue
+    def add_yt_dl_flat_dummies(self, data, playlist_url: str, start: int = 0, stop: int = None):
+        """Fill the queue with unloaded dummy songs of a flat playlist from yt-dlp/youtube_dl
 
-        :param increment: increment the queue_pos
-        :param tries: needed internally to prevent infinite recursion
-        :param check_loaded: needed internally to return a song that wasn't loaded before
+        :param data: info dict with entries, see yt_dl_flat_data
+        :param playlist_url: link of the playlist
+        :param start: skip the entries before this index, f.e. because they were added with the youtube api
+        :param stop: only add the entries before this index
+        :return: the added songs
         """
-        # Prevents: Shuffle on & 1 Song with error
-        if tries > 10:
-            return None
+        songs = []
+        with metadata_store.batch():
+            for pos, entry in enumerate((data.get("entries") or [])[start:stop], start + 1):
+                if not entry:
+                    continue
+                song = MusicPlayerQueueSong(playlist_url=playlist_url, playlist_pos=pos)
+                song.process_data_yt_dl_flat(entry)
+                if not song.private:
+                    self._add_song(song, play_next=False)
+                    songs.append(song)
+        return songs
 
-        if self.shuffle and not check_loaded:
-            self.queue_pos = random.randint(0, len(self.songs) - 1)  # could be improved with a smarter shuffle
-            increment = False
+    def add_stored_song(self, link):
+        """Add a song which is known by the metadata store, without using the youtube api
 
-        if increment:
-            self.queue_pos += 1
+        :param link: YouTube video link
+        :return: True if the song was added
+        """
+        song = MusicPlayerQueueSong(video_url=link)
+        if not song.hydrate(max_age=MPSettings.metadata_max_age) or song.private or not song.title:
+            return False
+        self._add_song(song, play_next=True)
+        return True
 
-        if len(self.songs) <= self.queue_pos:
-            self.queue_pos = 0
+    def _add_song(self, song: MusicPlayerQueueSong, play_next: bool):
+        """Add a song to the queue and to the shuffle order
 
-        song = self.songs[self.queue_pos]
-        if song.error:
-            return await self.get_next_song(tries=tries + 1)
-        elif not song.loaded:
-            await song.load_data()
-            return await self.get_next_song(increment=False, check_loaded=True)
+        :param song: the song
+        :param play_next: insert the song after the current song, otherwise append it
+        """
+        if play_next:
+            self.songs.insert(1 if len(self.songs) == 0 else self.queue_pos + 1, song)
+            if self.shuffle:
+                self.shuffle_deck.add_next(song.song_id)
         else:
-            return song
+            self.songs.append(song)
+            if self.shuffle:
+                self.shuffle_deck.add(song.song_id, keep=MPSettings.prefetch_songs)
 
-    async def get_song_with_song_id(self, song_id, load_song=False, set_queue_pos_on_success=False):
-        for pos, song in enumerate(self.songs):
-            if song.song_id == song_id:
-                if not song.loaded and not song.error and load_song:
-                    await song.load_data()
-                if song and song.loaded and not song.error and set_queue_pos_on_success:
-                    self.queue_pos = pos
+    def start_loader(self, coro, pending):
+        """Add songs to the queue in the background, or fill songs of the queue, the job ends with clear()
+
+        :param coro: the producer coroutine
+        :param pending: amount of songs the producer will add
+        """
+        task = asyncio.create_task(coro)
+        self.loader_tasks[task] = pending
+        # a loader which ends or gets cancelled drops its remaining share of pending_songs
+        task.add_done_callback(lambda done: self.loader_tasks.pop(done, None))
+
+    def loader_added(self, count: int):
+        """Called by the running loader after it added songs"""
+        task = asyncio.current_task()
+        if task in self.loader_tasks:
+            self.loader_tasks[task] = max(self.loader_tasks[task] - count, 0)
+
+    async def get_next_song(self, increment=True):
+        """Get the next song from the queue, songs with errors are skipped
+
+        :param increment: go to the next song, False: start with the song at queue_pos
+        """
+        for _ in range(len(self.songs) + 1):
+            if self.shuffle and increment:
+                song = self.shuffle_deck.draw(self.songs)
+                if not song:  # start a new round
+                    self.set_shuffle(True)
+                    song = self.shuffle_deck.draw(self.songs)
+                if not song:  # only the current song is playable, play it again
+                    song = self.songs[self.queue_pos] if self.queue_pos < len(self.songs) else None
+                    if not song or song.error:  # every song has an error
+                        return None
+                self.queue_pos = self.songs.index(song.song_id)
+            else:
+                if increment:
+                    self.queue_pos += 1
+                if len(self.songs) <= self.queue_pos:
+                    self.queue_pos = 0
+                song = self.songs[self.queue_pos] if self.songs else None
+                if not song:
+                    return None
+            increment = True
+            if not song.loaded and not song.error:
+                await self.load_song(song)
+                self.queue_pos = self.songs.index(song.song_id)  # songs might have been added while loading
+            if song.loaded and not song.error:
                 return song
         return None
 
+    def set_shuffle(self, shuffle: bool):
+        """Enable/Disable shuffle mode, a new shuffle round starts with all songs except the current one"""
+        self.shuffle = shuffle
+        self.shuffle_deck.clear()
+        if shuffle and self.songs:
+            current_id = self.songs[self.queue_pos].song_id
+            self.shuffle_deck.reset(song.song_id for song in self.songs if song.song_id != current_id)
+
+    def get_upcoming_songs(self, count):
+        """Get the songs which will be played next, in play order
+
+        :param count: max amount of songs
+        """
+        if not self.songs:
+            return []
+        if self.shuffle:
+            return self.shuffle_deck.upcoming(self.songs, count)
+        upcoming = [self.songs[(self.queue_pos + i) % len(self.songs)]
+                    for i in range(1, min(count, len(self.songs) - 1) + 1)]
+        return [song for song in upcoming if not song.error]
+
+    def prefetch(self):
+        """Load the upcoming songs in the background, cancel jobs of songs which are not upcoming anymore"""
+        upcoming = self.get_upcoming_songs(MPSettings.prefetch_songs)
+        upcoming_ids = [song.song_id for song in upcoming]
+        for song_id in list(self.prefetch_tasks):
+            task = self.prefetch_tasks[song_id]
+            if song_id not in upcoming_ids or task.done():
+                task.cancel()
+                del self.prefetch_tasks[song_id]
+        for song in upcoming:
+            if not song.loaded and not song.error and song.song_id not in self.prefetch_tasks:
+                self.prefetch_tasks[song.song_id] = asyncio.create_task(song.load_data(self.guild_id, background=True))
+
+    def cancel_prefetch(self):
+        """Cancel all running prefetch jobs"""
+        for task in self.prefetch_tasks.values():
+            task.cancel()
+        self.prefetch_tasks.clear()
+
+    async def load_song(self, song: MusicPlayerQueueSong):
+        """Load a song, reuses the prefetch job of the song if there is one"""
+        task = self.prefetch_tasks.pop(song.song_id, None)
+        if task and not task.cancelled():
+            extraction_engine.promote(song.extract_link)  # somebody waits for it now
+            await task
+        else:
+            await song.load_data(self.guild_id)
+
+    async def get_song_with_song_id(self, song_id, load_song=False, set_queue_pos_on_success=False):
+        song = self.songs.get(song_id)
+        if not song:
+            return None
+        if not song.loaded and not song.error and load_song:
+            await self.load_song(song)
+        if song.loaded and not song.error and set_queue_pos_on_success:
+            self.queue_pos = self.songs.index(song_id)  # the position might have changed while loading
+        return song
+
     def get_pos_with_song_id(self, song_id):
-        for pos, song in enumerate(self.songs):
-            if song.song_id == song_id:
-                return pos
-        return None
+        return self.songs.index(song_id)
 
     def clear(self):
         """Reset the queue"""
+        self.cancel_prefetch()
+        for task in self.loader_tasks:
+            task.cancel()
+        self.loader_tasks.clear()
         self.songs.clear()
+        self.shuffle_deck.clear()
         self.queue_pos = 0
         self.shuffle = False
 
 
 class MusicPlayer:
-    client: Client = None
-    dj: Union[Member, None] = None
-    guild_id: Union[int, None] = None
-    queue: MusicPlayerQueue = MusicPlayerQueue()
-    player_msg: Union[Message, None] = None
-    volume: float = MPSettings.starting_volume
-    state: int = MPStates.ready
-    timer_empty: Union[datetime, None] = None
-    timer_paused: Union[datetime, None] = None
-    timer_new_dj: Union[datetime, None] = None
+    def __init__(self):
+        self.client: Union[Client, None] = None
+        self.dj: Union[Member, None] = None
+        self.guild_id: Union[int, None] = None
+        self.queue = MusicPlayerQueue()
+        self.player_msg: Union[Message, None] = None
+        self.volume: float = MPSettings.starting_volume
+        self.state: int = MPStates.ready
+        self.render_task: Union[asyncio.Task, None] = None  # scheduled edit of the player embed
+        self.render_dirty = False  # the player embed is outdated
+        self.last_render = 0.0  # time.monotonic() of the last edit of the player message
+        self.current_song: Union[MusicPlayerQueueSong, None] = None  # the song which is playing
+        self.gapless_task: Union[asyncio.Task, None] = None  # prepares the next song before the current one ends
+        self.gapless_song: Union[MusicPlayerQueueSong, None] = None  # prepared song, already taken from the queue
+        self.init_time: Union[float, None] = None  # time.perf_counter() of the play command which started the mp
 
     def init(self, ctx):
         """Used to re-init the MusicPlayer in a guild"""
@@ -184,18 +678,21 @@ class MusicPlayer:
         self.state = MPStates.loading
         self.dj = ctx.author
         self.guild_id = ctx.guild_id
+        self.queue.guild_id = ctx.guild_id
+        self.init_time = time.perf_counter()
 
     def reset(self):
         """Reset the MusicPlayer"""
+        timers.cancel_guild(self.guild_id)
         self.dj = None
         self.guild_id = None
         self.queue.clear()
         self.player_msg = None
         self.volume = MPSettings.starting_volume
         self.state = MPStates.ready
-        self.timer_empty = None
-        self.timer_paused = None
-        self.timer_new_dj = None
+        self.cancel_render()
+        self.cancel_gapless()
+        self.current_song = None
 
     async def stop(self):
         """Stop the mp"""
@@ -210,8 +707,9 @@ class MusicPlayer:
         vc = self.client.get_bot_voice_state(self.guild_id)
 
         while True:
+            self.queue.prefetch()
             await self.play(song)
-            self.timer_paused = None
+            timers.cancel(self.guild_id, MPTimers.paused)
             # Bot might have been kicked or lost connection to channel or was stopped
             if not vc or not vc.channel or self.state == MPStates.exit:
                 break
@@ -220,14 +718,15 @@ class MusicPlayer:
 
             # continue automatic queue
             self.state = MPStates.on_next  # make sure to not react while loading song
-            song = await self.queue.get_next_song()
+            song = await self.take_gapless_song() or await self.queue.get_next_song()
             if not song:
                 self.state = MPStates.exit
                 break
             await self.update_embed(song=song)
 
-        self.timer_empty = None
-        self.timer_new_dj = None
+        timers.cancel(self.guild_id, MPTimers.empty)
+        timers.cancel(self.guild_id, MPTimers.new_dj)
+        self.cancel_render()
         if vc and vc.channel:
             await vc.disconnect()
         try:
@@ -245,22 +744,122 @@ class MusicPlayer:
         if not vc:  # sanity check
             await self.stop()
             return
-        audio = AudioVolume(song.stream_url)
-        audio.ffmpeg_before_args = "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5"
+        audio = await self.create_audio(song)
+        audio_cache.record_play(get_cache_key(song.video_url), song.stream_url, song.seconds)
+        play_index.played(self.guild_id, song.video_url, song.title, song.uploader)
+        self.current_song = song
+        if MPSettings.gapless:
+            audio = GaplessAudio(audio, song.seconds, asyncio.get_running_loop(),
+                                 self.prepare_gapless, self.on_gapless_started)
         # audio.locked_stream = song.duration == "Stream"  # livestream audio might lag
         self.state = MPStates.playing
         vc.volume = self.volume
+        if self.init_time:
+            metrics.first_audio_seconds.observe(time.perf_counter() - self.init_time)
+            self.init_time = None
         await vc.play(audio)
 
+    async def create_audio(self, song: MusicPlayerQueueSong):
+        """Create the audio of a song, from the audio cache or from its stream url
+
+        :param song: A loaded MusicPlayerQueueSong
+        """
+        if path := audio_cache.get(get_cache_key(song.video_url)):
+            source, before_args = path, ""
+        else:
+            await song.reload_data(self.guild_id)  # the song might have been loaded a long time ago
+            source, before_args = song.stream_url, "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5"
+        if MPSettings.opus_passthrough and song.opus:
+            return OpusPassthroughAudio(source, before_args, volume=self.volume)
+        audio = create_volume_audio(source)
+        audio.ffmpeg_before_args = before_args
+        audio.volume = self.volume
+        return audio
+
+    def prepare_gapless(self, audio: GaplessAudio):
+        """Called by GaplessAudio shortly before the current song ends"""
+        if self.state not in [MPStates.playing, MPStates.paused] or self.gapless_task:
+            return
+        self.gapless_task = asyncio.create_task(self._prepare_gapless(audio))
+
+    async def _prepare_gapless(self, audio: GaplessAudio):
+        """Take the next song from the queue and hand its audio to the playing GaplessAudio"""
+        song = await self.queue.get_next_song()
+        self.gapless_song = song
+        if song and not audio.closed:
+            audio.set_next(await self.create_audio(song), song.seconds, song)
+
+    def on_gapless_started(self, song: MusicPlayerQueueSong):
+        """Called by GaplessAudio when the prepared song started playing"""
+        if self.gapless_song is not song:  # the player moved on in the meantime
+            return
+        self.gapless_task = self.gapless_song = None
+        self.current_song = song
+        audio_cache.record_play(get_cache_key(song.video_url), song.stream_url, song.seconds)
+        play_index.played(self.guild_id, song.video_url, song.title, song.uploader)
+        self.queue.prefetch()
+        self.request_render()
+
+    async def take_gapless_song(self):
+        """Get the prepared next song, it was already taken from the queue"""
+        if self.gapless_task:
+            await asyncio.wait([self.gapless_task])
+        song = self.gapless_song
+        self.gapless_task = self.gapless_song = None
+        return song
+
+    def cancel_gapless(self):
+        """Drop the prepared next song"""
+        if self.gapless_task and not self.gapless_task.done():
+            self.gapless_task.cancel()
+        self.gapless_task = self.gapless_song = None
+
     async def update_embed(self, song: MusicPlayerQueueSong = None, ctx: ComponentContext = None):
-        """Update the player embed
+        """Update the player embed, without a user interaction to respond to the edit only gets scheduled
 
         :param song: the current song
         :param ctx: if this was triggered by a user, respond to it to make discord happy
         """
+        if song:  # a scheduled edit renders the current song
+            self.current_song = song
+        if ctx and not ctx.responded:
+            await self._render(song, ctx)
+        else:
+            self.request_render()
+
+    def request_render(self):
+        """Mark the player embed as outdated, it gets edited at most once per embed_update_interval"""
+        self.render_dirty = True
+        if not self.render_task or self.render_task.done():
+            self.render_task = asyncio.create_task(self._render_later())
+
+    def cancel_render(self):
+        """Drop a scheduled edit of the player embed"""
+        self.render_dirty = False
+        if self.render_task and not self.render_task.done() and self.render_task is not asyncio.current_task():
+            self.render_task.cancel()
+        self.render_task = None
+
+    async def _render_later(self):
+        """Edit the player embed with the latest state as soon as the interval allows it"""
+        while self.render_dirty:
+            delay = self.last_render + MPSettings.embed_update_interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if not self.render_dirty or not self.player_msg or self.state in [MPStates.exit, MPStates.ready]:
+                break
+            await self._render()
+
+    async def _render(self, song: MusicPlayerQueueSong = None, ctx: ComponentContext = None):
+        """Edit the player embed now
+
+        :param song: the current song
+        :param ctx: if this was triggered by a user, respond to it to make discord happy
+        """
+        self.render_dirty = False
         vc = self.client.get_bot_voice_state(self.guild_id)
         if not song:
-            song = self.queue.songs[self.queue.queue_pos]
+            song = self.current_song or self.queue.songs[self.queue.queue_pos]
         title = "Music Player" + (f" | {vc.channel.name}" if vc and vc.channel else "")
         title += " | Paused" if self.state == MPStates.paused else ""
         embed = Embed(title=title, description=f"**Current Song:**\n{song.title}", color=0x2983ef)
@@ -275,10 +874,15 @@ class MusicPlayer:
         try:
             if ctx and not ctx.responded:
                 try:
+                    metrics.embed_edits.inc(trigger="button")
                     await ctx.edit_origin(embed=embed, components=self.create_components(song))
                 except NotFound:  # responding took too long
+                    self.last_render = time.monotonic()
+                    metrics.embed_edits.inc(trigger="update")
                     await self.player_msg.edit(embed=embed, components=self.create_components(song))
             else:
+                self.last_render = time.monotonic()
+                metrics.embed_edits.inc(trigger="update")
                 await self.player_msg.edit(embed=embed, components=self.create_components(song))
         except NotFound:  # the player message got deleted
             await self.stop()
@@ -286,8 +890,11 @@ class MusicPlayer:
     def create_components(self, current_song: MusicPlayerQueueSong = None):
         """Create the components for the player embed"""
         if not current_song:
-            current_song = self.queue.songs[self.queue.queue_pos]
+            current_song = self.current_song or self.queue.songs[self.queue.queue_pos]
 
+        placeholder = f"Queue [{self.queue.queue_pos + 1}/{len(self.queue.songs)}]"
+        if self.queue.pending_songs > 0:
+            placeholder += f" | loading {self.queue.pending_songs} more"
         options = []
         combo_num = self.queue.queue_pos - 4 if (self.queue.queue_pos - 4 >= 0 and len(self.queue.songs) >= 25) else 0
         for song in self.queue.songs[combo_num:combo_num + 25]:
@@ -302,7 +909,7 @@ class MusicPlayer:
             ActionRow(
                 Select(
                     custom_id="player::select",
-                    placeholder=f"Queue [{self.queue.queue_pos + 1}/{len(self.queue.songs)}]",
+                    placeholder=placeholder,
                     options=options
                 )
             ),
@@ -394,6 +1001,7 @@ class MusicPlayer:
         song = await self.queue.get_song_with_song_id(int(ctx.values[0]), load_song=True, set_queue_pos_on_success=True)
         if song and not song.error:
             self.state = MPStates.on_next
+            self.cancel_gapless()
             await ctx.voice_state.stop()
             await self.play_loop(song, ctx)
         else:
@@ -401,7 +1009,7 @@ class MusicPlayer:
 
     async def b_resume(self, ctx: ComponentContext):
         """Component callback: Resume the player"""
-        self.timer_paused = None
+        timers.cancel(self.guild_id, MPTimers.paused)
         self.state = MPStates.playing
         if not ctx.voice_state.playing:
             ctx.voice_state.resume()
@@ -413,17 +1021,12 @@ class MusicPlayer:
         if ctx.voice_state.playing:
             ctx.voice_state.pause()
         await self.update_embed(ctx=ctx)
-
-        time = datetime.now()
-        self.timer_paused = time
-        await asyncio.sleep(MPSettings.timeout_paused)
-        if self.timer_paused == time:
-            await self.stop()
+        timers.schedule(self.guild_id, MPTimers.paused, MPSettings.timeout_paused, self.stop)
 
     async def b_skip(self, ctx: ComponentContext):
         """Component callback: Skip the current song"""
         self.state = MPStates.on_next
-        if song := await self.queue.get_next_song():
+        if song := await self.take_gapless_song() or await self.queue.get_next_song():
             await ctx.voice_state.stop()
             await self.play_loop(song, ctx)
             return
@@ -431,7 +1034,8 @@ class MusicPlayer:
 
     async def b_shuffle(self, ctx: ComponentContext):
         """Component callback: Enable/Disable shuffle"""
-        self.queue.shuffle = not self.queue.shuffle
+        self.queue.set_shuffle(not self.queue.shuffle)
+        self.queue.prefetch()
         await self.update_embed(ctx=ctx)
 
     async def b_lower(self, ctx: ComponentContext):
@@ -465,8 +1069,8 @@ class MusicPlayer:
                 await ctx.send(f"{ctx.author.mention} I have no permission to move to your voice channel!",
                                ephemeral=True)
                 return
-            self.timer_new_dj = None
-            self.timer_paused = None
+            timers.cancel(self.guild_id, MPTimers.new_dj)
+            timers.cancel(self.guild_id, MPTimers.paused)
             try:
                 await ctx.author.voice.channel.connect(deafened=True)
             except (VoiceConnectionTimeout, VoiceWebSocketClosed):
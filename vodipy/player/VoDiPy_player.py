@@ -1,3 +1,4 @@
+import asyncio
 from typing import Union
 
 from naff import InteractionContext, PrefixedContext, ChannelTypes, Permissions
@@ -5,11 +6,14 @@ from naff.client.errors import VoiceConnectionTimeout, VoiceWebSocketClosed
 
 from VoDiPy_defines import MusicPlayerSettings as MPSettings
 from VoDiPy_defines import MusicPlayerStates as MPStates
-from player.VoDiPy_classes import MusicPlayer
-from utils.VoDiPy_api import yt_api_playlist_songs_count, yt_api_playlist_data, yt_api_video_data, yt_dl_data
+from player.VoDiPy_classes import MusicPlayer, MusicPlayerQueue, YT_PLAYLIST_URL
+from utils.VoDiPy_api import yt_api_playlist_data, yt_api_video_data, yt_dl_data, yt_dl_flat_data, YtApiUnavailable
 from utils.VoDiPy_utils import can_join_voice
 
 
+FLAT_PLAYLIST_STEP = 50  # entries of a flat playlist which get added to the queue at once
+
+
 async def case_command_play(ctx: Union[InteractionContext, PrefixedContext], link):
     """Callback for the play command
 
@@ -77,39 +81,68 @@ async def case_command_play(ctx: Union[InteractionContext, PrefixedContext], lin
 
     if "youtube.com/playlist?list=" in link:  # case YouTube playlist
         pl_id = link.split("youtube.com/playlist?list=", 1)[1]
-        pl_count = await yt_api_playlist_songs_count(pl_id)
-        if not pl_count:
+        try:
+            data = await yt_api_playlist_data(pl_id)
+            fallback = False
+        except YtApiUnavailable:  # quota used up or the api is failing, list the playlist with yt-dlp instead
+            data = await yt_dl_flat_data(YT_PLAYLIST_URL + pl_id, ctx.guild_id)
+            fallback = True
+        if not data or fallback and not data.get("entries"):
             await ctx.send("YouTube Playlist not found!", ephemeral=True)
             if not only_queue:
                 mp.reset()
             return
-        elif pl_count > MPSettings.warning_pl_count:
-            await (await ctx.channel.send(ctx.author.mention + " Loading big playlists might take a bit longer."))\
+        pl_count = len(data["entries"]) if fallback else data["pageInfo"]["totalResults"]
+        if pl_count > MPSettings.warning_pl_count:
+            await (await ctx.channel.send(ctx.author.mention + " Big playlists get added in the background."))\
                 .delete(10)
-        data = await yt_api_playlist_data(pl_id)
-        while True:
-            mp.queue.add_yt_api_dummies(data)
-            if not data.get("nextPageToken"):
-                break
-            data = await yt_api_playlist_data(pl_id, data["nextPageToken"])
+        if fallback:
+            add_flat_playlist(mp, data, YT_PLAYLIST_URL + pl_id)
+        else:
+            songs = mp.queue.add_yt_api_dummies(data, play_next=False)
+            if MPSettings.enrich_playlists:  # don't wait for it, the first song gets checked when it is loaded
+                mp.queue.start_loader(mp.queue.enrich_songs(songs), 0)
+        if not fallback and data.get("nextPageToken"):
+            # the first page is enough to start playing, the remaining pages get added while playing
+            pending = pl_count - len(data["items"])
+            mp.queue.start_loader(load_yt_playlist_pages(mp, pl_id, data["nextPageToken"], pending), pending)
     elif "youtube.com/watch?v=" in link:  # case YouTube video
         vid = link.split("youtube.com/watch?v=", 1)[1]
-        data = await yt_api_video_data(vid)
-        if not data:
-            if not only_queue:
-                mp.reset()
-            await ctx.send("YouTube Song not found or is age restricted!", ephemeral=True)
-            return
-        mp.queue.add_yt_api_dummies(data)
+        if not mp.queue.add_stored_song(link):
+            try:
+                data = await yt_api_video_data(vid)
+                fallback = False
+            except YtApiUnavailable:  # quota used up or the api is failing, resolve the song with yt-dlp instead
+                data = await yt_dl_data(link, guild_id=ctx.guild_id)
+                fallback = True
+            if not data:
+                if not only_queue:
+                    mp.reset()
+                await ctx.send("YouTube Song not found or is age restricted!", ephemeral=True)
+                return
+            if fallback:
+                mp.queue.add_yt_dl_songs(data)
+            elif not mp.queue.add_yt_api_dummies(data):
+                if not only_queue:
+                    mp.reset()
+                await ctx.send("YouTube Song cannot be played here!", ephemeral=True)
+                return
     else:  # case non-YouTube
-        await (await ctx.send(ctx.author.mention + " Using non-youtube sources takes longer to load")).delete(delay=10)
-        data = await yt_dl_data(link)
+        if MPSettings.flat_playlists:  # single songs get resolved by the flat extraction too
+            data = await yt_dl_flat_data(link, ctx.guild_id)
+        else:
+            await (await ctx.send(ctx.author.mention + " Using non-youtube sources takes longer to load"))\
+                .delete(delay=10)
+            data = await yt_dl_data(link, guild_id=ctx.guild_id)
         if not data:
             if not only_queue:
                 mp.reset()
             await ctx.send("Found nothing to play!", ephemeral=True)
             return
-        mp.queue.add_yt_dl_songs(data)
+        if MPSettings.flat_playlists and data.get("entries"):
+            add_flat_playlist(mp, data, link)
+        else:
+            mp.queue.add_yt_dl_songs(data)
 
     if not only_queue:  # Init MP: Preload first song /of the playlist
         song = await mp.queue.get_next_song(increment=False)
@@ -139,3 +172,87 @@ async def case_command_play(ctx: Union[InteractionContext, PrefixedContext], lin
         return
 
     await mp.play_loop(song)
+
+
+async def load_yt_playlist_pages(mp: MusicPlayer, pl_id: str, page_token: str, pending: int):
+    """Background producer: add the remaining pages of a YouTube playlist to the queue
+
+    :param mp: the music player of the guild
+    :param pl_id: playlist id
+    :param page_token: token of the first page which is not in the queue yet
+    :param pending: amount of songs which are not in the queue yet
+    """
+    while page_token:
+        try:
+            data = await yt_api_playlist_data(pl_id, page_token)
+        except YtApiUnavailable:  # quota used up or the api is failing, add the remaining songs with yt-dlp
+            if data := await yt_dl_flat_data(YT_PLAYLIST_URL + pl_id, mp.queue.guild_id):
+                mp.queue.add_yt_dl_flat_dummies(data, YT_PLAYLIST_URL + pl_id,
+                                                start=max(len(data.get("entries") or []) - pending, 0))
+                mp.queue.loader_added(pending)
+                if mp.player_msg and mp.state in [MPStates.playing, MPStates.paused]:
+                    await mp.update_embed()
+            break
+        if not data:
+            break
+        mp.queue.loader_added(len(data["items"]))
+        pending -= len(data["items"])
+        songs = mp.queue.add_yt_api_dummies(data, play_next=False)
+        if MPSettings.enrich_playlists:
+            await mp.queue.enrich_songs(songs)
+        if mp.player_msg and mp.state in [MPStates.playing, MPStates.paused]:
+            await mp.update_embed()  # refresh the queue count
+        page_token = data.get("nextPageToken")
+        await asyncio.sleep(0)  # let the player react between pages
+
+
+def add_flat_playlist(mp: MusicPlayer, data: dict, playlist_url: str):
+    """Add the entries of a flat playlist as unloaded songs, the first ones right away, the others in the background
+
+    :param mp: the music player of the guild
+    :param data: info dict with entries, see yt_dl_flat_data
+    :param playlist_url: link of the playlist
+    """
+    mp.queue.add_yt_dl_flat_dummies(data, playlist_url, stop=FLAT_PLAYLIST_STEP)
+    if len(data["entries"]) > FLAT_PLAYLIST_STEP:
+        pending = len(data["entries"]) - FLAT_PLAYLIST_STEP
+        mp.queue.start_loader(load_flat_playlist_entries(mp, data, playlist_url, pending), pending)
+
+
+async def load_flat_playlist_entries(mp: MusicPlayer, data: dict, playlist_url: str, pending: int):
+    """Background producer: add the remaining entries of a flat playlist to the queue
+
+    :param mp: the music player of the guild
+    :param data: info dict with entries, see yt_dl_flat_data
+    :param playlist_url: link of the playlist
+    :param pending: amount of entries which are not in the queue yet, the last ones
+    """
+    for start in range(len(data["entries"]) - pending, len(data["entries"]), FLAT_PLAYLIST_STEP):
+        await asyncio.sleep(0)  # let the player react between steps
+        mp.queue.add_yt_dl_flat_dummies(data, playlist_url, start, start + FLAT_PLAYLIST_STEP)
+        mp.queue.loader_added(FLAT_PLAYLIST_STEP)
+        if mp.player_msg and mp.state in [MPStates.playing, MPStates.paused]:
+            await mp.update_embed()  # refresh the queue count
+
+
+async def warm_player_keywords():
+    """Resolve the first song of every player keyword, so the first play of a keyword doesn't wait for yt-dlp
+
+    The metadata of the songs and the stream url of the first song get cached, the songs are not queued anywhere.
+    """
+    for link in set(MPSettings.player_keywords.values()):
+        queue = MusicPlayerQueue()
+        try:
+            if "youtube.com/playlist?list=" in link:
+                if data := await yt_api_playlist_data(link.split("youtube.com/playlist?list=", 1)[1]):
+                    songs = queue.add_yt_api_dummies(data, play_next=False)
+                    if MPSettings.enrich_playlists:
+                        await queue.enrich_songs(songs)
+            elif "youtube.com/watch?v=" in link:
+                if not queue.add_stored_song(link) and (data := await yt_api_video_data(link.split("watch?v=", 1)[1])):
+                    queue.add_yt_api_dummies(data)
+            elif data := await yt_dl_data(link):
+                queue.add_yt_dl_songs(data)
+        except YtApiUnavailable:  # don't use the quota for a warm-up, the other keywords might not need the api
+            continue
+        await queue.get_next_song(increment=False)
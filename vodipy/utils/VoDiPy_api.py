@@ -1,49 +1,123 @@
 import asyncio
 import json
+import random
+import re
+from typing import Union
 
 import aiohttp
-try:
-    import yt_dlp.utils as yt_utils
-    from yt_dlp import YoutubeDL as YtDL
-except ImportError:
-    import youtube_dl.utils as yt_utils
-    from youtube_dl import YoutubeDL as YtDL
 
 from VoDiPy_secrets import youtube_api_key
 from VoDiPy_defines import MusicPlayerSettings as MPSettings
+from utils.VoDiPy_cache import stream_cache
+from utils.VoDiPy_extract import extraction_engine, YDL_OPTIONS, YDL_FLAT_OPTIONS
+from utils.VoDiPy_metrics import metrics
+from utils.VoDiPy_quota import quota, QUOTA_EXCEEDED_REASONS
+from utils.VoDiPy_utils import SingleFlight, CircuitBreaker
 
 
 YT_API_URL = "https://www.googleapis.com/youtube/v3/"
+RE_YT_DURATION = re.compile(r"P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?")
+_session: Union[aiohttp.ClientSession, None] = None  # shared by all youtube api requests
+_flights = SingleFlight()  # concurrent requests for the same link share one request
+_breaker = CircuitBreaker(MPSettings.api_breaker_threshold, MPSettings.api_breaker_timeout)
+# errors of the api which go away if the request is sent again later
+TRANSIENT_REASONS = ("rateLimitExceeded", "userRateLimitExceeded", "backendError", "internalError")
+# errors which make every request fail, not only the one for this link
+UNAVAILABLE_REASONS = (*QUOTA_EXCEEDED_REASONS, "keyInvalid", "accessNotConfigured", "ipRefererBlocked")
+
+
+class YtApiUnavailable(Exception):
+    """The youtube api cannot be used right now (quota used up, failing or unreachable), unlike 'not found'"""
+
+
+async def yt_api_session_start():
+    """Create the long-lived session for the youtube api, called on startup"""
+    global _session
+    if _session and not _session.closed:
+        return
+    connector = aiohttp.TCPConnector(
+        limit=MPSettings.api_connection_limit,
+        ttl_dns_cache=MPSettings.api_dns_cache_ttl,
+        keepalive_timeout=MPSettings.api_keepalive_timeout
+    )
+    _session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=MPSettings.api_timeout))
+
+
+async def yt_api_session_close():
+    """Close the session for the youtube api, called on shutdown"""
+    global _session
+    if _session and not _session.closed:
+        await _session.close()
+    _session = None
 
 
 async def _yt_api_fetcher(link: str):
     """Get data from the youtube api
 
     :param link: youtube api get link
-    :return: data or None
-    """
-    try:
-        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=7)) as session:
-            async with session.get(f"{YT_API_URL}{link}") as response:
-                data = await response.json()
-    except (json.decoder.JSONDecodeError, aiohttp.ServerTimeoutError):
-        return None
-    if data.get("error"):
-        return None
-    return data
-
-
-async def yt_api_playlist_songs_count(pl_id: str):
+    :return: data or None if not found
+    :raises YtApiUnavailable: the quota is used up or the api keeps failing
     """
-    https://developers.google.com/youtube/v3/docs/playlists/list?hl=en
-
-    :param pl_id: playlist id
-    :return: count or None
+    return await _flights.do(("api", link), _yt_api_request, link)
+
+
+async def _yt_api_request(link: str):
+    """Send a request, temporary failures are retried with a randomized exponential backoff"""
+    call = link.split("?", 1)[0]
+    for attempt in range(MPSettings.api_retries + 1):
+        if attempt:
+            await asyncio.sleep(random.uniform(0, MPSettings.api_retry_backoff * 2 ** (attempt - 1)))
+        if not quota.available:
+            metrics.yt_api_requests.inc(result="quota_exceeded")
+            raise YtApiUnavailable("quota used up")
+        if not _breaker.allow():
+            metrics.yt_api_requests.inc(result="circuit_open")
+            raise YtApiUnavailable("too many failures")
+        quota.use(call)
+        try:
+            result, data = await _yt_api_send(link)
+        except BaseException:  # cancelled or unavailable, that says nothing about the api, but a trial has to end
+            _breaker.abort_trial()
+            raise
+        metrics.yt_api_requests.inc(result=result)
+        if result in ("ok", "api_error"):
+            _breaker.success()
+            return data if result == "ok" else None
+        _breaker.failure()
+    raise YtApiUnavailable("request failed")
+
+
+async def _yt_api_send(link: str):
+    """Send one request
+
+    :return: (result, data), result: "ok", "api_error" (f.e. not found) or the kind of the temporary failure
+    :raises YtApiUnavailable: the quota is used up or the api key can't be used
     """
-    # part can be: contentDetails,id,snippet,status
-    link = f"playlistItems?playlistId={pl_id}&key={youtube_api_key}&part=status"
-    data = await _yt_api_fetcher(link)
-    return None if not data else data["pageInfo"]["totalResults"]
+    if not _session or _session.closed:  # used before startup
+        await yt_api_session_start()
+    try:
+        with metrics.yt_api_seconds.time():
+            async with _session.get(f"{YT_API_URL}{link}") as response:
+                status = response.status
+                data = await response.json(content_type=None)
+    except json.decoder.JSONDecodeError:
+        return "invalid", None
+    except asyncio.TimeoutError:
+        return "timeout", None
+    except aiohttp.ClientError:
+        return "connection_error", None
+    error = data.get("error") if isinstance(data, dict) else {}
+    if status < 400 and isinstance(data, dict) and not error:
+        return "ok", data
+    reason = next(iter((error or {}).get("errors") or []), {}).get("reason", "")
+    if reason in UNAVAILABLE_REASONS:
+        if reason in QUOTA_EXCEEDED_REASONS:
+            quota.exceeded()
+        metrics.yt_api_requests.inc(result="quota_exceeded" if reason in QUOTA_EXCEEDED_REASONS else "denied")
+        raise YtApiUnavailable(reason)
+    if status < 500 and status != 429 and reason not in TRANSIENT_REASONS:
+        return "api_error", None
+    return "server_error", None
 
 
 async def yt_api_playlist_data(pl_id: str, next_page_token: str = None):
@@ -53,6 +127,7 @@ async def yt_api_playlist_data(pl_id: str, next_page_token: str = None):
     :param pl_id: playlist id
     :param next_page_token: next page token
     :return: data or None
+    :raises YtApiUnavailable: the quota is used up or the api keeps failing
     """
     link = f"playlistItems?playlistId={pl_id}&key={youtube_api_key}&part=status,snippet&maxResults=50"
     if next_page_token:
@@ -67,34 +142,94 @@ async def yt_api_video_data(v_id: str):
 
     :param v_id: video id
     :return: data or None
+    :raises YtApiUnavailable: the quota is used up or the api keeps failing
     """
-    link = f"videos?id={v_id}&key={youtube_api_key}&part=status,snippet"
+    link = f"videos?id={v_id}&key={youtube_api_key}&part=status,snippet,contentDetails"
     data = await _yt_api_fetcher(link)
     if not data or data["pageInfo"]["totalResults"] == 0 or data["items"][0]["status"]["privacyStatus"] != "public":
         return None
     return data
 
 
-async def yt_dl_data(link: str, playlist_pos: int = None):
+async def yt_api_videos_data(v_ids: list[str]):
+    """Get the data of up to 50 videos with one request (1 quota unit)
+    https://developers.google.com/youtube/v3/docs/videos/list?hl=en
+
+    :param v_ids: video ids
+    :return: items or None, videos which are deleted or private are missing
+    :raises YtApiUnavailable: the quota is used up or the api keeps failing
+    """
+    link = f"videos?id={','.join(v_ids[:50])}&key={youtube_api_key}&part=status,snippet,contentDetails"
+    data = await _yt_api_fetcher(link)
+    return None if not data else data["items"]
+
+
+def yt_api_parse_duration(duration: str):
+    """Convert an ISO 8601 duration of the youtube api (f.e. PT1H2M3S) to seconds, 0 for livestreams"""
+    match = RE_YT_DURATION.fullmatch(duration or "")
+    if not match:
+        return 0
+    days, hours, minutes, seconds = (int(x) if x else 0 for x in match.groups())
+    return ((days * 24 + hours) * 60 + minutes) * 60 + seconds
+
+
+def yt_api_is_playable(item: dict):
+    """Check the videos.list data of a video (with contentDetails) if the bot can play it"""
+    status = item["status"]
+    details = item.get("contentDetails", {})
+    restriction = details.get("regionRestriction", {})
+    # live broadcasts are "uploaded" while they are live, only videos which will never play are rejected
+    if status.get("privacyStatus") != "public" or status.get("uploadStatus") in ("deleted", "failed", "rejected") \
+            or not status.get("embeddable", True) \
+            or details.get("contentRating", {}).get("ytRating") == "ytAgeRestricted":
+        return False
+    region = MPSettings.region_code
+    if region and (region in restriction.get("blocked", []) or region not in restriction.get("allowed", [region])):
+        return False
+    return True
+
+
+async def yt_dl_flat_data(link: str, guild_id: int = None):
+    """List the songs of a playlist without resolving them, f.e. if the youtube api is unavailable
+
+    :param link: playlist link
+    :param guild_id: the guild which requested the data
+    :return: info dict with unresolved entries (url, title, ...) or None
+    """
+    return await _flights.do(("yt_dl_flat", link), _yt_dl_flat_extract, link, guild_id)
+
+
+async def _yt_dl_flat_extract(link: str, guild_id: int = None):
+    with metrics.yt_dl_seconds.time():
+        data = await extraction_engine.extract(link, YDL_FLAT_OPTIONS, None, guild_id)
+    metrics.yt_dl_requests.inc(result="ok" if data else "failed")
+    return data
+
+
+async def yt_dl_data(link: str, playlist_pos: int = None, guild_id: int = None, background: bool = False):
     """Used for non-youtube audio sources
 
     :param link: non-youtube link
     :param playlist_pos: if a video of a playlist should be loaded
+    :param guild_id: the guild which requested the data, used to share the extraction workers fairly
+    :param background: nobody waits for the data yet (prefetch), see ExtractionEngine.extract
     :return:
     """
-    ydl_opt = {
-        "format": "bestaudio/best",  # worstaudio/worst
-        "noplaylist": MPSettings.no_playlist,  # if video of a playlist is sent, use video
-        # "playlistend": 50,  # max 50 videos of a playlist
-        "ignoreerrors": True,  # ignore errors, just continue
-        "quiet": True,  # prevent logging status to console
-        "no_warnings": True,
-    }
-    if playlist_pos is not None:
-        ydl_opt["playlistitems"] = playlist_pos
+    return await _flights.do(("yt_dl", link, playlist_pos), _yt_dl_extract, link, playlist_pos, guild_id, background)
+
+
+async def _yt_dl_extract(link: str, playlist_pos: int = None, guild_id: int = None, background: bool = False):
+    leased = stream_cache.lease(link, playlist_pos)
+    if not leased:  # another shard resolves this link right now
+        if data := await stream_cache.wait(link, playlist_pos):
+            return data
+        leased = stream_cache.lease(link, playlist_pos)  # the other shard failed, resolve it here
     try:
-        with YtDL(ydl_opt) as ytdl:
-            data = await asyncio.to_thread(ytdl.extract_info, link, download=False)
-    except yt_utils.YoutubeDLError:
-        return None
+        with metrics.yt_dl_seconds.time():
+            data = await extraction_engine.extract(link, YDL_OPTIONS, playlist_pos, guild_id, background)
+        stream_cache.put(data, link, playlist_pos)  # before the release, so waiting shards find it
+    finally:
+        if leased:  # the lease of another shard is not ours to end
+            stream_cache.release(link, playlist_pos)
+    metrics.yt_dl_requests.inc(result="ok" if data else "failed")
     return data
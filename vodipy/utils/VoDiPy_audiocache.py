@@ -0,0 +1,162 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Union
+
+from VoDiPy_defines import MusicPlayerSettings as MPSettings
+
+
+class AudioCache:
+    """Opt-in disk cache for the audio of songs which get played often
+
+    A song gets downloaded (audio stream copied, not re-encoded) after it was played min_plays times.
+    When the cache is bigger than max_bytes, the least recently ("lru") or least often ("lfu") played files
+    get removed. The index is stored as json next to the files.
+    """
+    _index_file = "index.json"
+    _max_counted = 10000  # play counts of songs which are not cached yet, the oldest get forgotten
+
+    def __init__(self, path: str, max_bytes: int, min_plays: int, max_duration: int, policy: str, enabled: bool):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.min_plays = min_plays
+        self.max_duration = max_duration
+        self.policy = policy
+        self.enabled = enabled
+        self._files: dict[str, dict] = {}  # {cache key: {"file", "size", "plays", "played"}}
+        self._plays: OrderedDict[str, int] = OrderedDict()  # {cache key: plays}
+        self._downloads: dict[str, asyncio.Task] = {}  # {cache key: download task}
+        self._loaded = False
+
+    @property
+    def size(self):
+        return sum(entry["size"] for entry in self._files.values())
+
+    def _load(self):
+        """Read the index, files which are missing or unknown get dropped"""
+        self._loaded = True
+        os.makedirs(self.path, exist_ok=True)
+        try:
+            with open(os.path.join(self.path, self._index_file), encoding="utf-8") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+        self._files = {key: entry for key, entry in index.get("files", {}).items()
+                       if os.path.isfile(os.path.join(self.path, entry["file"]))}
+        self._plays = OrderedDict(index.get("plays", {}))
+        known = {entry["file"] for entry in self._files.values()} | {self._index_file}
+        for name in os.listdir(self.path):
+            if name not in known:  # unfinished downloads and evicted leftovers
+                os.remove(os.path.join(self.path, name))
+
+    def save(self):
+        """Write the index to disk"""
+        if not self._loaded:
+            return
+        tmp = os.path.join(self.path, self._index_file + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"files": self._files, "plays": self._plays}, f)
+        os.replace(tmp, os.path.join(self.path, self._index_file))
+
+    def get(self, key: str) -> Union[str, None]:
+        """Get the local file of a song
+
+        :param key: cache key of the song, see VoDiPy_cache.get_cache_key
+        :return: path of the file or None
+        """
+        if not self.enabled:
+            return None
+        if not self._loaded:
+            self._load()
+        entry = self._files.get(key)
+        if not entry:
+            return None
+        path = os.path.join(self.path, entry["file"])
+        if not os.path.isfile(path):
+            del self._files[key]
+            return None
+        return path
+
+    def record_play(self, key: str, stream_url: str, seconds: int):
+        """Count a play of a song and start downloading it once it is played often enough
+
+        :param key: cache key of the song, see VoDiPy_cache.get_cache_key
+        :param stream_url: resolved stream url of the song
+        :param seconds: duration of the song, livestreams (0) and long songs are not cached
+        """
+        if not self.enabled:
+            return
+        if not self._loaded:
+            self._load()
+        if entry := self._files.get(key):
+            entry["plays"] += 1
+            entry["played"] = time.time()
+            return
+        plays = self._plays.pop(key, 0) + 1
+        self._plays[key] = plays
+        while len(self._plays) > self._max_counted:
+            self._plays.popitem(last=False)
+        if plays >= self.min_plays and stream_url and 0 < seconds <= self.max_duration and key not in self._downloads:
+            self._downloads[key] = asyncio.create_task(self._download(key, stream_url))
+
+    async def _download(self, key: str, stream_url: str):
+        """Copy the audio stream into a matroska file, which can hold opus and aac"""
+        name = hashlib.sha1(key.encode()).hexdigest() + ".mka"
+        tmp = os.path.join(self.path, name + ".tmp")
+        process = None
+        try:
+            process = await asyncio.create_subprocess_exec(
+                "ffmpeg", "-y", "-loglevel", "error", "-reconnect", "1", "-reconnect_streamed", "1",
+                "-reconnect_delay_max", "5", "-i", stream_url, "-vn", "-c:a", "copy", "-f", "matroska", tmp,
+                stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL
+            )
+            if await process.wait() != 0 or not os.path.isfile(tmp):
+                return
+            os.replace(tmp, os.path.join(self.path, name))
+            self._files[key] = {"file": name, "size": os.path.getsize(os.path.join(self.path, name)),
+                                "plays": self._plays.pop(key, self.min_plays), "played": time.time()}
+            self.evict()
+            self.save()
+        except OSError:  # ffmpeg missing or disk full
+            pass
+        finally:
+            if process and process.returncode is None:  # cancelled
+                process.kill()
+                await process.wait()
+            if os.path.isfile(tmp):
+                os.remove(tmp)
+            self._downloads.pop(key, None)
+
+    def evict(self):
+        """Remove files until the cache fits into max_bytes"""
+        size = self.size
+        if size <= self.max_bytes:
+            return
+        if self.policy == "lfu":
+            order = sorted(self._files, key=lambda k: (self._files[k]["plays"], self._files[k]["played"]))
+        else:
+            order = sorted(self._files, key=lambda k: self._files[k]["played"])
+        for key in order:
+            if size <= self.max_bytes:
+                break
+            entry = self._files.pop(key)
+            size -= entry["size"]
+            try:
+                os.remove(os.path.join(self.path, entry["file"]))
+            except OSError:
+                pass  # the player of a guild might still read it (windows)
+
+    async def close(self):
+        """Stop running downloads and save the index"""
+        for task in list(self._downloads.values()):
+            task.cancel()
+        await asyncio.gather(*self._downloads.values(), return_exceptions=True)
+        self.save()
+
+
+audio_cache = AudioCache(MPSettings.audio_cache_path, MPSettings.audio_cache_size, MPSettings.audio_cache_min_plays,
+                         MPSettings.audio_cache_max_duration, MPSettings.audio_cache_policy, MPSettings.audio_cache)
@@ -0,0 +1,154 @@
+import heapq
+import itertools
+import re
+from collections import OrderedDict
+from typing import Iterable
+
+from VoDiPy_defines import MusicPlayerSettings as MPSettings
+
+
+RE_WORD = re.compile(r"\w+")
+CHOICE_LENGTH = 100  # max length of the name and the value of an autocomplete choice
+MAX_CHOICES = 25  # max amount of autocomplete choices
+YT_WATCH_URL = "https://www.youtube.com/watch?v="
+
+
+def _words(text: str):
+    return RE_WORD.findall(text.casefold())
+
+
+def _matches(tokens: list[str], words: Iterable[str]):
+    """Check if every token is the start of one of the words"""
+    return all(any(word.startswith(token) for word in words) for token in tokens)
+
+
+class PlayIndex:
+    """In-memory prefix index for the autocomplete of /play, lookups don't touch the network or the disk
+
+    Songs are indexed by the words of their title and uploader, the words are kept in buckets by their first two
+    characters, so a lookup only checks the words of one bucket. When the index is full, the songs which were added
+    or played least recently get dropped. Every guild has a short history of its played songs, which is suggested
+    first, followed by the player keywords and the other songs (most recent first).
+    """
+
+    def __init__(self, max_songs: int, history_size: int):
+        self.max_songs = max_songs
+        self.history_size = history_size
+        self._songs: OrderedDict[str, tuple[str, tuple[str, ...], int]] = OrderedDict()  # {link: (label, words, seq)}
+        self._buckets: dict[str, dict[str, set[str]]] = {}  # {first two characters: {word: links}}
+        self._history: dict[int, OrderedDict[str, str]] = {}  # {guild_id: {link: label}}
+        self._seq = itertools.count()
+
+    def __len__(self):
+        return len(self._songs)
+
+    @staticmethod
+    def _label(title: str, uploader: str = None):
+        label = f"{title} - {uploader}" if uploader else title
+        return label if len(label) <= CHOICE_LENGTH else label[:CHOICE_LENGTH - 3] + "..."
+
+    def add(self, link: str, title: str, uploader: str = None):
+        """Add a song or move it to the front
+
+        :param link: the link which gets played when the choice is selected
+        :param title: title of the song
+        :param uploader: uploader of the song
+        """
+        if not link or not title or len(link) > CHOICE_LENGTH:
+            return
+        label = self._label(title, uploader)
+        entry = self._songs.pop(link, None)
+        if entry and entry[0] == label:
+            words = entry[1]
+        else:
+            if entry:
+                self._unindex(link, entry[1])
+            words = tuple(set(_words(label)))
+            for word in words:
+                bucket = self._buckets.get(word[:2])
+                if bucket is None:
+                    bucket = self._buckets[word[:2]] = {}
+                if word in bucket:
+                    bucket[word].add(link)
+                else:
+                    bucket[word] = {link}
+        self._songs[link] = (label, words, next(self._seq))
+        while len(self._songs) > self.max_songs:
+            old_link, (_, old_words, _) = self._songs.popitem(last=False)
+            self._unindex(old_link, old_words)
+
+    def _unindex(self, link: str, words: tuple[str, ...]):
+        for word in words:
+            bucket = self._buckets[word[:2]]
+            bucket[word].discard(link)
+            if not bucket[word]:
+                del bucket[word]
+                if not bucket:
+                    del self._buckets[word[:2]]
+
+    def played(self, guild_id: int, link: str, title: str, uploader: str = None):
+        """Add a song to the history of a guild"""
+        if not link or not title or len(link) > CHOICE_LENGTH:
+            return
+        self.add(link, title, uploader)
+        history = self._history.setdefault(guild_id, OrderedDict())
+        history.pop(link, None)
+        history[link] = self._label(title, uploader)
+        while len(history) > self.history_size:
+            history.popitem(last=False)
+
+    def load(self, songs: Iterable[tuple[str, str, str]]):
+        """Fill the index, f.e. with stored metadata
+
+        :param songs: (cache key, title, uploader), the most recent first
+        """
+        for key, title, uploader in reversed(list(songs)):
+            if key.startswith("youtube:"):
+                self.add(YT_WATCH_URL + key[8:], title, uploader)
+            elif "#" not in key:  # position in a playlist
+                self.add(key, title, uploader)
+
+    def _lookup(self, token: str):
+        """Get the links of the songs with a word which starts with token"""
+        if len(token) >= 2:
+            buckets = [self._buckets.get(token[:2], {})]
+        else:
+            buckets = [bucket for prefix, bucket in self._buckets.items() if prefix.startswith(token)]
+        links = set()
+        for bucket in buckets:
+            for word, word_links in bucket.items():
+                if word.startswith(token):
+                    links |= word_links
+        return links
+
+    def search(self, text: str, guild_id: int = None, limit: int = MAX_CHOICES):
+        """Get the autocomplete choices for the input of a user
+
+        :param text: what the user typed so far
+        :param guild_id: the guild of the user, its history is suggested first
+        :param limit: max amount of choices
+        :return: [{"name": label, "value": link or keyword}]
+        """
+        text = text.strip()
+        if "://" in text:  # a pasted link, keep it
+            return [{"name": text[:CHOICE_LENGTH], "value": text}] if len(text) <= CHOICE_LENGTH else []
+        tokens = _words(text)
+        choices: dict[str, str] = {}  # {value: name}
+        for link, label in reversed(self._history.get(guild_id, {}).items()):
+            if _matches(tokens, _words(label)):
+                choices.setdefault(link, label)
+        for keyword in MPSettings.player_keywords:
+            if keyword.casefold().startswith(text.casefold()):
+                choices.setdefault(keyword, self._label(keyword, "keyword"))
+        if tokens and len(choices) < limit:
+            links = None
+            for token in sorted(tokens, key=len, reverse=True):  # the longest token matches the least songs
+                links = self._lookup(token) if links is None else links & self._lookup(token)
+                if not links:
+                    break
+            for link in heapq.nlargest(limit, links, key=lambda x: self._songs[x][2]):
+                choices.setdefault(link, self._songs[link][0])
+        return [{"name": name, "value": value} for value, name in itertools.islice(choices.items(), limit)]
+
+
+play_index = PlayIndex(MPSettings.autocomplete_size, MPSettings.autocomplete_history)
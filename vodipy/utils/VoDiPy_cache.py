@@ -0,0 +1,152 @@
+import asyncio
+import re
+import time
+from collections import OrderedDict
+from typing import Union
+from urllib.parse import urlparse, parse_qs
+
+from VoDiPy_defines import MusicPlayerSettings as MPSettings
+from utils.VoDiPy_metadata import MetadataStore, metadata_store
+
+
+# googlevideo urls carry their expiry either as query (?expire=123) or as path segment (/expire/123/)
+RE_EXPIRE = re.compile(r"[?&/]expire[=/](\d+)")
+# keys which are needed to fill a MusicPlayerQueueSong, everything else of the yt-dlp info dict gets dropped
+CACHED_INFO_KEYS = ("id", "extractor_key", "ie_key", "title", "uploader", "channel", "duration", "webpage_url", "url",
+                    "thumbnail", "acodec", "asr")
+
+
+def trim_info(info: dict):
+    """Only keep the keys of an info dict which are used, the full dict is big and not always picklable
+
+    :param info: yt-dlp/youtube_dl info dict, entries of playlists get trimmed too
+    """
+    if not info:
+        return info
+    trimmed = {key: info[key] for key in CACHED_INFO_KEYS if key in info}
+    if info.get("thumbnails"):
+        trimmed["thumbnails"] = info["thumbnails"][:1]
+    if info.get("entries") is not None:
+        trimmed["entries"] = [trim_info(entry) for entry in info["entries"]]
+    return trimmed
+
+
+def get_cache_key(link: str, playlist_pos: int = None):
+    """Get the canonical cache key of a link
+
+    :param link: the link which gets resolved
+    :param playlist_pos: position in a playlist, only used for non-video links
+    :return: 'youtube:video_id' for YouTube videos, otherwise the link
+    """
+    parsed = urlparse(link)
+    host = parsed.netloc.lower().removeprefix("www.").removeprefix("m.").removeprefix("music.")
+    if host == "youtube.com" and parsed.path == "/watch" and (v_id := parse_qs(parsed.query).get("v")):
+        return f"youtube:{v_id[0]}"
+    elif host == "youtu.be" and len(parsed.path) > 1:
+        return f"youtube:{parsed.path[1:]}"
+    return link if playlist_pos is None else f"{link}#{playlist_pos}"
+
+
+def get_stream_deadline(info: dict):
+    """Get the timestamp until the stream url of an info dict can be used to play the whole song
+
+    :param info: yt-dlp/youtube_dl info dict
+    """
+    match = RE_EXPIRE.search(info.get("url") or "")
+    if not match:  # no expiry in the url, keep it for the ttl
+        return time.time() + MPSettings.stream_cache_ttl
+    duration = info["duration"] if info.get("duration") and info["duration"] > 0 else 0
+    return int(match.group(1)) - duration - MPSettings.stream_cache_margin
+
+
+class StreamCache:
+    """Process-wide cache for resolved songs, shared by the players of all guilds
+
+    Entries get evicted when the cache is full (least recently used) or when their stream url expires.
+    With a shared store, resolved songs are also written to the metadata db, so other shards (processes) can use them.
+    """
+
+    def __init__(self, max_size: int, shared: Union[MetadataStore, None] = None):
+        self.max_size = max_size
+        self.shared = shared
+        self._entries: OrderedDict[str, tuple[float, dict]] = OrderedDict()  # {key: (deadline, info)}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, link: str, playlist_pos: int = None):
+        """Get the cached info dict of a link
+
+        :param link: the link which should be resolved
+        :param playlist_pos: position in a playlist, only used for non-video links
+        :return: info dict or None
+        """
+        key = get_cache_key(link, playlist_pos)
+        entry = self._entries.get(key)
+        if not entry and self.shared and (entry := self.shared.get_stream(key)):
+            self._store({key}, *entry)
+        if not entry:
+            return None
+        if entry[0] <= time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, info: dict, link: str = None, playlist_pos: int = None):
+        """Cache a resolved info dict
+
+        :param info: yt-dlp/youtube_dl info dict of a single song
+        :param link: the link which was resolved, the info is also cached under its webpage_url
+        :param playlist_pos: position in a playlist, only used for non-video links
+        """
+        if not info or not info.get("url") or info.get("entries"):
+            return
+        deadline = get_stream_deadline(info)
+        if deadline <= time.time():
+            return
+        info = trim_info(info)
+        keys = {get_cache_key(info["webpage_url"])} if info.get("webpage_url") else set()
+        if link:
+            keys.add(get_cache_key(link, playlist_pos))
+        self._store(keys, deadline, info)
+        if self.shared:
+            self.shared.put_stream(keys, deadline, info)
+
+    def _store(self, keys: set[str], deadline: float, info: dict):
+        for key in keys:
+            self._entries[key] = (deadline, info)
+            self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def lease(self, link: str, playlist_pos: int = None):
+        """Reserve resolving a link for this shard
+
+        :return: False if another shard is resolving the link right now, always True without a shared store
+        """
+        if not self.shared:
+            return True
+        return self.shared.lease_stream(get_cache_key(link, playlist_pos), MPSettings.extract_timeout)
+
+    def release(self, link: str, playlist_pos: int = None):
+        if self.shared:
+            self.shared.release_stream(get_cache_key(link, playlist_pos))
+
+    async def wait(self, link: str, playlist_pos: int = None, timeout: float = MPSettings.extract_timeout):
+        """Wait until another shard resolved a link
+
+        :return: info dict or None if the other shard failed or the timeout was reached
+        """
+        key = get_cache_key(link, playlist_pos)
+        deadline = time.time() + timeout
+        while self.shared and time.time() < deadline:
+            await asyncio.sleep(0.25)
+            if info := self.get(link, playlist_pos):
+                return info
+            if not self.shared.is_stream_leased(key):
+                return None
+        return None
+
+
+stream_cache = StreamCache(MPSettings.stream_cache_size, metadata_store if MPSettings.shards > 1 else None)
@@ -0,0 +1,235 @@
+import asyncio
+import importlib
+import multiprocessing
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Union
+
+from VoDiPy_defines import MusicPlayerSettings as MPSettings
+from utils.VoDiPy_cache import trim_info
+
+
+YDL_OPTIONS = {
+    "format": "bestaudio/best",  # worstaudio/worst
+    "noplaylist": MPSettings.no_playlist,  # if video of a playlist is sent, use video
+    # "playlistend": 50,  # max 50 videos of a playlist
+    "ignoreerrors": True,  # ignore errors, just continue
+    "quiet": True,  # prevent logging status to console
+    "no_warnings": True,
+}
+YDL_FLAT_OPTIONS = {  # list the songs of a playlist without resolving them
+    **YDL_OPTIONS,
+    "noplaylist": False,
+    "extract_flat": "in_playlist",
+}
+# yt-dlp/youtube_dl take long to import, they are loaded by load_backend in the warm-up or with the first extraction
+# in process mode, only the worker processes import them
+yt_utils = None
+YtDL = None
+PLAYLIST_ITEMS_PARAM = None
+
+
+def load_backend():
+    """Import yt-dlp, or youtube_dl if yt-dlp is not installed"""
+    global yt_utils, YtDL, PLAYLIST_ITEMS_PARAM
+    if YtDL is not None:
+        return
+    try:
+        yt_utils = importlib.import_module("yt_dlp.utils")
+        PLAYLIST_ITEMS_PARAM = "playlist_items"
+        YtDL = importlib.import_module("yt_dlp").YoutubeDL
+    except ImportError:
+        yt_utils = importlib.import_module("youtube_dl.utils")
+        PLAYLIST_ITEMS_PARAM = "playlistitems"
+        YtDL = importlib.import_module("youtube_dl").YoutubeDL
+
+
+class YtDLPool:
+    """Long-lived YoutubeDL instances, keyed by their options
+
+    Creating a YoutubeDL instance registers all extractors and processes the options again, and a new instance
+    starts without the extractor caches (f.e. player js and signature functions).
+    An instance is only used by one job at a time.
+    """
+
+    def __init__(self):
+        self._idle: dict[tuple, list["YtDL"]] = {}  # {options key: instances}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(ydl_opt: dict):
+        return tuple(sorted(ydl_opt.items()))
+
+    def acquire(self, ydl_opt: dict):
+        """Get an idle instance for these options or create a new one"""
+        load_backend()
+        with self._lock:
+            if idle := self._idle.get(self._key(ydl_opt)):
+                return idle.pop()
+        return YtDL(dict(ydl_opt))  # YoutubeDL adds its defaults to the dict
+
+    def release(self, ydl_opt: dict, ytdl: "YtDL"):
+        """Give an instance back after a job is done"""
+        with self._lock:
+            self._idle.setdefault(self._key(ydl_opt), []).append(ytdl)
+
+    def warm(self, ydl_opt: dict, count: int = 1):
+        """Create instances ahead of time and load the youtube extractor"""
+        instances = [self.acquire(ydl_opt) for _ in range(count)]
+        for ytdl in instances:
+            ytdl.get_info_extractor("Youtube")
+            self.release(ydl_opt, ytdl)
+
+
+ytdl_pool = YtDLPool()  # every worker process has its own pool
+
+
+def warm_ytdl_pool(ydl_opt: dict, count: int = 1):
+    """Warm the pool of the current (worker) process"""
+    ytdl_pool.warm(ydl_opt, count)
+
+
+def extract_info(link: str, ydl_opt: dict, playlist_pos: int = None):
+    """Run yt-dlp/youtube_dl, this runs in a worker thread or process
+
+    :param link: link to extract
+    :param ydl_opt: YoutubeDL options
+    :param playlist_pos: if a video of a playlist should be loaded
+    :return: trimmed info dict or None
+    """
+    ytdl = ytdl_pool.acquire(ydl_opt)
+    if playlist_pos is not None:
+        ytdl.params[PLAYLIST_ITEMS_PARAM] = str(playlist_pos)
+    try:
+        return trim_info(ytdl.extract_info(link, download=False))
+    except yt_utils.YoutubeDLError:
+        return None
+    finally:
+        ytdl.params.pop(PLAYLIST_ITEMS_PARAM, None)
+        ytdl_pool.release(ydl_opt, ytdl)
+
+
+class ExtractionEngine:
+    """Runs yt-dlp/youtube_dl extractions in a thread or process pool
+
+    Jobs somebody waits for run first, in order. Background jobs (f.e. prefetching) are scheduled round-robin over
+    the guilds, so a guild loading a big playlist cannot starve the others.
+    A job which reached the timeout keeps its worker until it is done, so never more than `workers` extractions run.
+    """
+
+    def __init__(self, backend: str, workers: int, timeout: float):
+        self.backend = backend
+        self.workers = workers
+        self.timeout = timeout
+        self._pool: Union[ProcessPoolExecutor, ThreadPoolExecutor, None] = None
+        self._urgent: deque[tuple[tuple, asyncio.Future]] = deque()  # jobs somebody waits for
+        self._jobs: dict[int, deque[tuple[tuple, asyncio.Future]]] = {}  # {guild_id: background jobs}
+        self._guilds: deque[int] = deque()  # guilds with waiting jobs, in round-robin order
+        self._running = 0
+
+    def _get_pool(self):
+        """Get the process pool, or a thread pool of its own in thread mode"""
+        if not self._pool and self.backend == "process":
+            # spawn: forking the bot process with its running threads is not safe
+            self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"),
+                                             initializer=warm_ytdl_pool, initargs=(YDL_OPTIONS,))
+        elif not self._pool:
+            self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix="extract")
+        return self._pool
+
+    async def warm(self):
+        """Create the YoutubeDL instances (and worker processes) before the first song gets requested"""
+        if self.backend == "process":
+            # one job per worker starts all processes, the pool initializer warms their instances
+            pool = self._get_pool()
+            await asyncio.gather(*[asyncio.get_running_loop().run_in_executor(pool, warm_ytdl_pool, YDL_OPTIONS)
+                                   for _ in range(self.workers)])
+        else:
+            await asyncio.to_thread(warm_ytdl_pool, YDL_OPTIONS, self.workers)
+
+    async def extract(self, link: str, ydl_opt: dict, playlist_pos: int = None, guild_id: int = None,
+                      background: bool = False):
+        """Queue an extraction and wait for its result
+
+        :param link: link to extract
+        :param ydl_opt: YoutubeDL options
+        :param playlist_pos: if a video of a playlist should be loaded
+        :param guild_id: the guild which requested the extraction
+        :param background: nobody waits for the result yet, jobs somebody waits for run first
+        :return: trimmed info dict or None
+        """
+        future = asyncio.get_running_loop().create_future()
+        if not background:
+            self._urgent.append(((link, ydl_opt, playlist_pos), future))
+        else:
+            if guild_id not in self._jobs:
+                self._jobs[guild_id] = deque()
+                self._guilds.append(guild_id)
+            self._jobs[guild_id].append(((link, ydl_opt, playlist_pos), future))
+        self._dispatch()
+        return await future
+
+    def promote(self, link: str):
+        """Run the waiting background jobs of a link first, f.e. because a user waits for a prefetched song now"""
+        for guild_id, jobs in list(self._jobs.items()):
+            promoted = [job for job in jobs if job[0][0] == link]
+            if not promoted:
+                continue
+            self._urgent.extend(promoted)
+            self._jobs[guild_id] = deque(job for job in jobs if job[0][0] != link)
+            if not self._jobs[guild_id]:
+                del self._jobs[guild_id]
+                self._guilds.remove(guild_id)
+        self._dispatch()
+
+    def _dispatch(self):
+        """Start waiting jobs while there are free workers, background jobs one per guild at a time"""
+        while self._running < self.workers and (self._urgent or self._guilds):
+            if self._urgent:
+                args, future = self._urgent.popleft()
+            else:
+                guild_id = self._guilds.popleft()
+                args, future = self._jobs[guild_id].popleft()
+                if self._jobs[guild_id]:
+                    self._guilds.append(guild_id)
+                else:
+                    del self._jobs[guild_id]
+            if future.done():  # the caller got cancelled
+                continue
+            self._running += 1
+            asyncio.create_task(self._run(args, future))
+
+    async def _run(self, args: tuple, future: asyncio.Future):
+        job = asyncio.get_running_loop().run_in_executor(self._get_pool(), extract_info, *args)
+        job.add_done_callback(self._job_done)  # the worker is only free when the job is done
+        try:
+            result = await asyncio.wait_for(asyncio.shield(job), self.timeout)
+        except asyncio.TimeoutError:
+            # the worker finishes the job in the background, its result gets dropped
+            result = None
+        except BrokenProcessPool:
+            self._pool = None
+            result = None
+        except Exception as e:  # noqa
+            if not future.done():
+                future.set_exception(e)
+            return
+        if not future.done():
+            future.set_result(result)
+
+    def _job_done(self, job: asyncio.Future):
+        if not job.cancelled():
+            job.exception()  # the error of a job after the timeout was not retrieved
+        self._running -= 1
+        self._dispatch()
+
+    def shutdown(self):
+        if self._pool:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+extraction_engine = ExtractionEngine(MPSettings.extract_backend, MPSettings.extract_workers,
+                                     MPSettings.extract_timeout)
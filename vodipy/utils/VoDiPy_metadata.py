@@ -0,0 +1,215 @@
+import json
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from typing import Union
+
+from VoDiPy_defines import MusicPlayerSettings as MPSettings
+
+
+class MetadataStore:
+    """Persistent store for song metadata received from the youtube api and yt-dlp/youtube_dl
+
+    When the store is full, the least recently used songs get removed. The file gets opened on the first use (or with
+    open() at the start of the bot), so the worker processes which import this module don't open it. Reads don't
+    write, the access times are kept in memory and stored together with the next writes.
+    If the stream cache is shared between shards (processes), resolved stream urls are stored here too, until they
+    expire. The file is opened in WAL mode, so the shards can read while one of them writes.
+    """
+    _fields = ("title", "uploader", "duration", "thumbnail", "privacy")
+
+    def __init__(self, path: str, max_entries: int):
+        self.path = path
+        self.max_entries = max_entries
+        self._puts = 0
+        self._db: Union[sqlite3.Connection, None] = None
+        self._accessed: dict[str, float] = {}  # {key: timestamp} of reads which aren't stored yet
+        self._batch: Union[dict[str, list], None] = None  # {key: row} of puts which get written at the end of batch()
+
+    @property
+    def db(self):
+        if self._db is None:
+            self.open()
+        return self._db
+
+    def open(self):
+        """Open the file, a relative path is relative to the folder of the bot"""
+        if self._db is not None:
+            return
+        path = self.path
+        if path != ":memory:":
+            path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), path)
+        self._db = sqlite3.connect(path, isolation_level=None, timeout=5)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS songs ("
+            "key TEXT PRIMARY KEY, title TEXT, uploader TEXT, duration INTEGER, thumbnail TEXT, privacy TEXT, "
+            "created REAL NOT NULL, updated REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS songs_accessed ON songs (accessed)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS streams (key TEXT PRIMARY KEY, deadline REAL NOT NULL, info TEXT, lease REAL)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS quota (day TEXT NOT NULL, call TEXT NOT NULL, units INTEGER NOT NULL, "
+            "PRIMARY KEY (day, call))"
+        )
+
+    def get(self, key: str, max_age: float = None):
+        """Get the metadata of a song
+
+        :param key: cache key of the song, see VoDiPy_cache.get_cache_key
+        :param max_age: ignore the entry if it wasn't updated in the last x seconds
+        :return: dict or None
+        """
+        now = time.time()
+        row = self.db.execute("SELECT * FROM songs WHERE key = ?", (key,)).fetchone()
+        entry = dict(row) if row else None
+        if self._batch and key in self._batch:  # not written yet
+            fields = dict(zip(self._fields, self._batch[key][1:len(self._fields) + 1]))
+            if entry:
+                entry.update({name: value for name, value in fields.items() if value is not None})
+            else:
+                entry = {"key": key, **fields, "created": now, "updated": now, "accessed": now}
+        if not entry or (max_age is not None and entry["updated"] < now - max_age):
+            return None
+        self._accessed[key] = now
+        return entry
+
+    def put(self, key: str, **fields):
+        """Insert or update the metadata of a song, fields which are None keep their stored value
+
+        :param key: cache key of the song, see VoDiPy_cache.get_cache_key
+        :param fields: title, uploader, duration (seconds), thumbnail, privacy
+        """
+        now = time.time()
+        row = [key, *(fields.get(name) for name in self._fields), now, now, now]
+        if self._batch is not None:
+            if old := self._batch.get(key):  # put twice in one batch, merge like the upsert
+                row[1:len(self._fields) + 1] = [new if new is not None else value for new, value in
+                                                zip(row[1:len(self._fields) + 1], old[1:len(self._fields) + 1])]
+            self._batch[key] = row
+            return
+        self._write([row])
+
+    @contextmanager
+    def batch(self):
+        """Collect the puts and write them in one transaction at the end, f.e. for a page of a playlist"""
+        if self._batch is not None:  # already in a batch
+            yield
+            return
+        self._batch = {}
+        try:
+            yield
+        finally:
+            rows, self._batch = list(self._batch.values()), None
+            if rows:
+                self._write(rows)
+
+    def _write(self, rows: list[list]):
+        """Upsert songs and store the access times of the reads, in one transaction"""
+        accessed, self._accessed = self._accessed, {}
+        with self.db:
+            self.db.execute("BEGIN")
+            self.db.executemany(
+                f"INSERT INTO songs (key, {', '.join(self._fields)}, created, updated, accessed) "
+                f"VALUES (?, {', '.join('?' * len(self._fields))}, ?, ?, ?) "
+                f"ON CONFLICT (key) DO UPDATE SET "
+                f"{', '.join(f'{name} = COALESCE(excluded.{name}, {name})' for name in self._fields)}, "
+                f"updated = excluded.updated, accessed = excluded.accessed",
+                rows
+            )
+            self.db.executemany("UPDATE songs SET accessed = MAX(accessed, ?) WHERE key = ?",
+                                [(timestamp, key) for key, timestamp in accessed.items()])
+        self._puts += len(rows)
+        if self._puts >= 100:
+            self._puts = 0
+            self.evict()
+
+    def recent(self, limit: int):
+        """Get the most recently used playable songs, [(key, title, uploader)]"""
+        return [tuple(row) for row in self.db.execute(
+            "SELECT key, title, uploader FROM songs "
+            "WHERE title IS NOT NULL AND (privacy IS NULL OR privacy = 'public') ORDER BY accessed DESC LIMIT ?",
+            (limit,)
+        )]
+
+    def get_stream(self, key: str):
+        """Get a resolved song which was stored by any shard
+
+        :param key: cache key of the song, see VoDiPy_cache.get_cache_key
+        :return: (deadline, info dict) or None
+        """
+        row = self.db.execute("SELECT deadline, info FROM streams WHERE key = ? AND info IS NOT NULL AND deadline > ?",
+                               (key, time.time())).fetchone()
+        return (row["deadline"], json.loads(row["info"])) if row else None
+
+    def put_stream(self, keys: set[str], deadline: float, info: dict):
+        """Store a resolved song for all shards, this also releases the lease of the keys"""
+        data = json.dumps(info)
+        self.db.executemany("INSERT OR REPLACE INTO streams (key, deadline, info, lease) VALUES (?, ?, ?, NULL)",
+                             [(key, deadline, data) for key in keys])
+
+    def lease_stream(self, key: str, seconds: float):
+        """Try to become the shard which resolves a song
+
+        :param key: cache key of the song
+        :param seconds: the lease ends after x seconds, f.e. if the shard crashed
+        :return: False if another shard is resolving the song right now
+        """
+        now = time.time()
+        return self.db.execute(
+            "INSERT INTO streams (key, deadline, info, lease) VALUES (?, 0, NULL, ?) ON CONFLICT (key) DO UPDATE "
+            "SET lease = excluded.lease WHERE lease IS NULL OR lease <= ?",
+            (key, now + seconds, now)
+        ).rowcount == 1
+
+    def release_stream(self, key: str):
+        """End the lease of a song, f.e. because resolving failed"""
+        self.db.execute("UPDATE streams SET lease = NULL WHERE key = ?", (key,))
+
+    def is_stream_leased(self, key: str):
+        row = self.db.execute("SELECT lease FROM streams WHERE key = ?", (key,)).fetchone()
+        return bool(row and row["lease"] and row["lease"] > time.time())
+
+    def add_quota(self, day: str, call: str, units: int):
+        """Count used quota units of the youtube api
+
+        :param day: the quota day, see VoDiPy_quota.get_quota_day
+        :param call: the type of the call, f.e. "videos"
+        :param units: quota units of the call
+        """
+        self.db.execute("INSERT INTO quota (day, call, units) VALUES (?, ?, ?) "
+                         "ON CONFLICT (day, call) DO UPDATE SET units = units + excluded.units", (day, call, units))
+
+    def get_quota(self, day: str):
+        """Get the used quota units of a day, {call: units}"""
+        return {row["call"]: row["units"] for row in self.db.execute("SELECT * FROM quota WHERE day = ?", (day,))}
+
+    def evict(self):
+        """Remove the least recently used songs if the store is full, expired stream urls and old quota days"""
+        now = time.time()
+        self.db.execute("DELETE FROM streams WHERE deadline <= ? AND (lease IS NULL OR lease <= ?)", (now, now))
+        self.db.execute(
+            "DELETE FROM quota WHERE day NOT IN (SELECT DISTINCT day FROM quota ORDER BY day DESC LIMIT 7)"
+        )
+        count = self.db.execute("SELECT COUNT(*) FROM songs").fetchone()[0]
+        if count > self.max_entries:
+            self.db.execute(
+                "DELETE FROM songs WHERE key IN (SELECT key FROM songs ORDER BY accessed LIMIT ?)",
+                (count - self.max_entries,)
+            )
+
+    def close(self):
+        if self._db is None:
+            return
+        if self._accessed:
+            self._write([])
+        self._db.close()
+        self._db = None
+
+
+metadata_store = MetadataStore(MPSettings.metadata_db_path, MPSettings.metadata_db_size)
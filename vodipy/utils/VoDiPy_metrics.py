@@ -0,0 +1,140 @@
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Union
+
+from aiohttp import web
+
+from VoDiPy_defines import MusicPlayerSettings as MPSettings
+
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _labels(labels: tuple):
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}" if labels else ""
+
+
+class Counter:
+    """A value which only goes up, per label combination"""
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.description}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in self._values.items():
+            yield f"{self.name}{_labels(labels)} {value}"
+
+
+class Gauge:
+    """A value which gets read from a function when the metrics are requested"""
+
+    def __init__(self, name: str, description: str, func: Callable[[], float]):
+        self.name = name
+        self.description = description
+        self.func = func
+
+    def render(self):
+        yield f"# HELP {self.name} {self.description}"
+        yield f"# TYPE {self.name} gauge"
+        yield f"{self.name} {self.func()}"
+
+
+class Histogram:
+    """Counts observed values (f.e. seconds) into buckets, per label combination"""
+
+    def __init__(self, name: str, description: str, buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self._values: dict[tuple, tuple[list[int], list[float]]] = {}  # {labels: (bucket counts, [sum])}
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        if key not in self._values:
+            self._values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+        counts, total = self._values[key]
+        counts[bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the seconds the with block took"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.description}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                yield f"{self.name}_bucket{_labels((*labels, ('le', bound)))} {cumulative}"
+            yield f"{self.name}_sum{_labels(labels)} {total[0]}"
+            yield f"{self.name}_count{_labels(labels)} {cumulative}"
+
+
+class Metrics:
+    """All metrics of the bot, served in the prometheus text format if MusicPlayerSettings.metrics is enabled"""
+
+    def __init__(self):
+        self._metrics: dict[str, Union[Counter, Gauge, Histogram]] = {}
+        self._runner: Union[web.AppRunner, None] = None
+        self.yt_api_requests = self.counter("vodipy_yt_api_requests_total", "YouTube api requests by result")
+        self.yt_api_seconds = self.histogram("vodipy_yt_api_seconds", "Duration of YouTube api requests")
+        self.yt_api_quota = self.counter("vodipy_yt_api_quota_units_total", "YouTube api quota units by call type")
+        self.yt_dl_requests = self.counter("vodipy_yt_dl_requests_total", "yt-dlp/youtube_dl extractions by result")
+        self.yt_dl_seconds = self.histogram("vodipy_yt_dl_seconds", "Duration of yt-dlp/youtube_dl extractions")
+        self.first_audio_seconds = self.histogram("vodipy_time_to_first_audio_seconds",
+                                                  "Seconds from the play command to the start of the first song")
+        self.embed_edits = self.counter("vodipy_embed_edits_total", "Edits of player messages")
+
+    def counter(self, name: str, description: str):
+        return self._metrics.setdefault(name, Counter(name, description))
+
+    def histogram(self, name: str, description: str, buckets: tuple = LATENCY_BUCKETS):
+        return self._metrics.setdefault(name, Histogram(name, description, buckets))
+
+    def gauge(self, name: str, description: str, func: Callable[[], float]):
+        self._metrics[name] = Gauge(name, description, func)
+        return self._metrics[name]
+
+    def render(self):
+        """Get all metrics in the prometheus text format"""
+        return "\n".join(line for metric in self._metrics.values() for line in metric.render()) + "\n"
+
+    async def _handle(self, request: web.Request):
+        return web.Response(text=self.render(), content_type="text/plain", charset="utf-8")
+
+    async def start(self, port_offset: int = 0):
+        """Start the http endpoint (GET /metrics) if enabled
+
+        :param port_offset: added to the port, every shard process has its own endpoint
+        """
+        if not MPSettings.metrics or self._runner:
+            return
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, MPSettings.metrics_host, MPSettings.metrics_port + port_offset).start()
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+metrics = Metrics()
@@ -0,0 +1,54 @@
+from datetime import datetime, timedelta, timezone
+
+from VoDiPy_defines import MusicPlayerSettings as MPSettings
+from utils.VoDiPy_metadata import MetadataStore, metadata_store
+from utils.VoDiPy_metrics import metrics
+
+try:
+    from zoneinfo import ZoneInfo
+    QUOTA_TIMEZONE = ZoneInfo("America/Los_Angeles")
+except (ImportError, KeyError):  # no tz database (f.e. windows without tzdata), ignore daylight saving time
+    QUOTA_TIMEZONE = timezone(timedelta(hours=-8))
+
+# quota units per request by call type, https://developers.google.com/youtube/v3/determine_quota_cost
+QUOTA_COSTS = {"playlistItems": 1, "playlists": 1, "videos": 1, "channels": 1, "search": 100}
+QUOTA_EXCEEDED_REASONS = ("quotaExceeded", "dailyLimitExceeded")
+
+
+def get_quota_day():
+    """The daily quota of the youtube api resets at midnight Pacific Time"""
+    return datetime.now(QUOTA_TIMEZONE).strftime("%Y-%m-%d")
+
+
+class QuotaTracker:
+    """Counts the quota units the youtube api requests use, per day and call type
+
+    The units are stored in the metadata db, so they survive restarts and are shared by all shards.
+    The quota is used up when daily_limit units are counted or when the api answered with quotaExceeded.
+    """
+    _exceeded = "exceeded"  # stored as call type when the api said so
+
+    def __init__(self, store: MetadataStore, daily_limit: int):
+        self.store = store
+        self.daily_limit = daily_limit
+
+    def use(self, call: str):
+        """Count a request
+
+        :param call: the endpoint of the request, f.e. "videos"
+        """
+        units = QUOTA_COSTS.get(call, 1)
+        self.store.add_quota(get_quota_day(), call, units)
+        metrics.yt_api_quota.inc(units, call=call)
+
+    def exceeded(self):
+        """The api answered that the quota is used up"""
+        self.store.add_quota(get_quota_day(), self._exceeded, 1)
+
+    @property
+    def available(self):
+        units = self.store.get_quota(get_quota_day())
+        return self._exceeded not in units and sum(units.values()) < self.daily_limit
+
+
+quota = QuotaTracker(metadata_store, MPSettings.api_daily_quota)
@@ -0,0 +1,28 @@
+import time
+
+
+class StartupProfile:
+    """Measures the phases of the bot start, a phase ends with mark()
+
+    The clock starts when this module gets imported, so VoDiPy.py imports it first.
+    """
+
+    def __init__(self):
+        self._last = time.perf_counter()
+        self.phases: list[tuple[str, float]] = []  # [(phase, seconds)]
+
+    def mark(self, phase: str):
+        """End a phase, it started with the previous mark"""
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._last))
+        self._last = now
+
+    def report(self, title: str):
+        """Get the phases since the last report as text"""
+        lines = [f"* {title}: {sum(seconds for _, seconds in self.phases):.2f}s"]
+        lines += [f"*   {phase:<24}{seconds:7.2f}s" for phase, seconds in self.phases]
+        self.phases.clear()
+        return "\n".join(lines)
+
+
+startup_profile = StartupProfile()
@@ -0,0 +1,84 @@
+import asyncio
+import heapq
+import itertools
+from typing import Union, Callable, Awaitable, Hashable
+
+
+class TimerScheduler:
+    """One process-wide scheduler for the timeouts of all guilds
+
+    Every deadline is identified by (guild_id, kind), scheduling the same key again moves its deadline.
+    Deadlines are kept in a heap and only the earliest one is armed on the event loop, so waiting deadlines
+    cost no task and no wakeup. Moved and cancelled deadlines are dropped from the heap lazily.
+    """
+
+    def __init__(self):
+        self._heap: list[tuple[float, int, tuple]] = []  # (deadline, seq, key)
+        self._timers: dict[tuple, tuple[float, int, Callable, tuple]] = {}  # {key: (deadline, seq, callback, args)}
+        self._seq = itertools.count()
+        self._handle: Union[asyncio.TimerHandle, None] = None
+        self._armed_at: Union[float, None] = None
+        self._tasks: set[asyncio.Task] = set()
+
+    def __len__(self):
+        return len(self._timers)
+
+    def schedule(self, guild_id: int, kind: Hashable, delay: float, callback: Callable[..., Awaitable], *args):
+        """Run a coroutine function after delay seconds, replaces the deadline of the same guild and kind
+
+        :param guild_id: the guild of the timer
+        :param kind: what the timer is for, f.e. MusicPlayerTimers.paused
+        :param delay: seconds until the callback gets called
+        :param callback: coroutine function
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + delay
+        key = (guild_id, kind)
+        seq = next(self._seq)
+        self._timers[key] = (deadline, seq, callback, args)
+        heapq.heappush(self._heap, (deadline, seq, key))
+        if len(self._heap) > 2 * len(self._timers) + 64:  # too many dropped entries
+            self._heap = [(d, s, k) for k, (d, s, _, _) in self._timers.items()]
+            heapq.heapify(self._heap)
+        self._arm(loop)
+
+    def cancel(self, guild_id: int, kind: Hashable):
+        """Cancel a deadline, nothing happens if it doesn't exist"""
+        self._timers.pop((guild_id, kind), None)
+
+    def cancel_guild(self, guild_id: int):
+        """Cancel all deadlines of a guild"""
+        for key in [key for key in self._timers if key[0] == guild_id]:
+            del self._timers[key]
+
+    def _arm(self, loop: asyncio.AbstractEventLoop):
+        """Arm the loop for the earliest deadline"""
+        while self._heap and self._timers.get(self._heap[0][2], (None, None))[1] != self._heap[0][1]:
+            heapq.heappop(self._heap)  # moved or cancelled
+        if not self._heap:
+            return
+        deadline = self._heap[0][0]
+        if self._handle and self._armed_at <= deadline:
+            return
+        if self._handle:
+            self._handle.cancel()
+        self._armed_at = deadline
+        self._handle = loop.call_at(deadline, self._fire)
+
+    def _fire(self):
+        loop = asyncio.get_running_loop()
+        self._handle = self._armed_at = None
+        now = loop.time()
+        while self._heap and self._heap[0][0] <= now:
+            _, seq, key = heapq.heappop(self._heap)
+            timer = self._timers.get(key)
+            if not timer or timer[1] != seq:
+                continue
+            del self._timers[key]
+            task = loop.create_task(timer[2](*timer[3]))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        self._arm(loop)
+
+
+timers = TimerScheduler()
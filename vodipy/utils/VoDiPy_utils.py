@@ -1,4 +1,6 @@
-from typing import Union
+import asyncio
+import time
+from typing import Union, Hashable, Callable, Awaitable
 
 from naff import Permissions, ComponentContext, InteractionContext, PrefixedContext
 
@@ -20,3 +22,77 @@ def can_join_voice(ctx: Union[InteractionContext, PrefixedContext, ComponentCont
                                     Permissions.MOVE_MEMBERS]) \
         or (all(x in perms for x in [Permissions.CONNECT, Permissions.SPEAK, Permissions.VIEW_CHANNEL])
             and not ctx.author.voice.channel.user_limit == len(ctx.author.voice.channel.voice_members))
+
+
+class SingleFlight:
+    """Coalesce concurrent calls with the same key into one call, all callers share its result
+
+    A caller getting cancelled only stops its own wait. The shared call gets cancelled once no caller waits for it.
+    """
+
+    def __init__(self):
+        self._calls: dict[Hashable, list] = {}  # {key: [task, waiting callers]}
+
+    async def do(self, key: Hashable, func: Callable[..., Awaitable], *args):
+        """Run func(*args) or join the running call with the same key
+
+        :param key: canonical key of the call
+        :param func: coroutine function
+        :param args: arguments for func
+        """
+        call = self._calls.get(key)
+        if not call:
+            call = [asyncio.create_task(func(*args)), 0]
+            self._calls[key] = call
+            call[0].add_done_callback(lambda _: self._forget(key, call))
+        call[1] += 1
+        try:
+            return await asyncio.shield(call[0])
+        finally:
+            call[1] -= 1
+            if call[1] == 0 and not call[0].done():
+                self._forget(key, call)
+                call[0].cancel()
+
+    def _forget(self, key: Hashable, call: list):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+
+class CircuitBreaker:
+    """Stops calling a failing service for a while
+
+    After threshold failures in a row the circuit opens and calls are refused for reset_timeout seconds.
+    Then one trial call is allowed (half open), its success closes the circuit, its failure opens it again.
+    """
+
+    def __init__(self, threshold: int, reset_timeout: float):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0  # failures in a row
+        self._opened_at: Union[float, None] = None
+        self._trial = False  # a trial call is running
+
+    def allow(self):
+        """Check if a call may be made now"""
+        if self._opened_at is None:
+            return True
+        if self._trial or time.monotonic() - self._opened_at < self.reset_timeout:
+            return False
+        self._trial = True
+        return True
+
+    def success(self):
+        self.failures = 0
+        self._opened_at = None
+        self._trial = False
+
+    def abort_trial(self):
+        """End a running trial call without a result, f.e. because it got cancelled"""
+        self._trial = False
+
+    def failure(self):
+        self.failures += 1
+        self._trial = False
+        if self.failures >= self.threshold:
+            self._opened_at = time.monotonic()